@@ -7,20 +7,20 @@ Licensed under the Eiffel Forum License 2.
 http://inamidst.com/phenny/
 """
 
-import sys, os, re, imp, time, traceback
-from tools import startdaemon
-import irc
+import sys, os, re, imp, time, traceback, threading
+from tools import WorkerPool, HandlerStats
+import irc, timers, web
 
 home = os.getcwd()
 
-def decode(bytes): 
-    try: text = bytes.decode('utf-8')
-    except UnicodeDecodeError: 
-        try: 
-            text = bytes.decode('iso-8859-1')
-        except UnicodeDecodeError: 
-            text = bytes.decode('cp1252')
-    return text
+# Matches command names that are a literal word, and so can be indexed
+r_word = re.compile(r'\w+\Z')
+# The match given to observers
+r_observed = re.compile(r'(.*)')
+
+PRIORITIES = ('high', 'medium', 'low')
+
+decode = irc.decode
 
 class PhennyWrapper(object): 
     def __init__(self, phenny, origin, text, match): 
@@ -92,9 +92,26 @@ class Phenny(irc.Bot):
        self.config = config
        self.doc = {}
        self.stats = {}
+       self.perf = {} # func.name -> tools.HandlerStats
+       self.perflock = threading.Lock()
        self.activity = {}
        self.DataStore = __import__('storebackends.'+getattr(config, 'datastore', 'jsonfile'), fromlist=['DataStore'], ).DataStore
        
+       self.sender.configure(getattr(config, 'flood', {}))
+       web.configure(getattr(config, 'web', {}))
+       
+       # Threaded handlers run on this
+       workers = getattr(config, 'workers', {})
+       self.pool = WorkerPool(
+           threads=workers.get('threads', 8), 
+           queue=workers.get('queue', 256), 
+           overflow=workers.get('overflow', 'drop'), 
+           caps=workers.get('caps'),
+           )
+       
+       # And delayed and periodic jobs on this
+       self.timers = timers.Scheduler(self)
+       
        # Used to track extensions
        self.CommandInput = CommandInput
        self.PhennyWrapper = PhennyWrapper
@@ -166,7 +183,7 @@ class Phenny(irc.Bot):
     def register(self, variables): 
         # This is used by reload.py, hence it being methodised
         for name, obj in variables.iteritems(): 
-            if hasattr(obj, 'commands') or hasattr(obj, 'rule'): 
+            if hasattr(obj, 'commands') or hasattr(obj, 'rule') or hasattr(obj, 'observe'): 
                 self.variables[name] = obj
     
     def subnick(self, pattern): 
@@ -174,7 +191,7 @@ class Phenny(irc.Bot):
         pattern = pattern.replace('$nickname', self.nick)
         return pattern.replace('$nick', r'%s[,:] +' % self.nick)
         
-    def bind_func(self, priority, regexp, func): 
+    def bind_func(self, priority, regexp, func, command=None): 
 #         print priority, regexp.pattern.encode('utf-8'), func
         # register documentation
         if not hasattr(func, 'name'): 
@@ -187,6 +204,26 @@ class Phenny(irc.Bot):
                 example = None
             self.doc[func.name] = (func.__doc__, example)
         self.commands[priority].setdefault(regexp, []).append(func)
+        
+        # File it in the dispatch index. Prefixed commands that are a plain 
+        # word get looked up by that word, everything else is scanned.
+        words, rules = self.index[priority].setdefault(func.event, ({}, []))
+        if command is not None and r_word.match(command): 
+            if self.foldcommands: 
+                command = command.lower()
+            words.setdefault(command, []).append((regexp, func))
+        else: 
+            rules.append((regexp, func))
+    
+    def bind_observer(self, func): 
+        if not hasattr(func, 'name'): 
+            func.name = func.__name__
+        events = func.observe
+        if isinstance(events, basestring): 
+            events = [events]
+        for event in events: 
+            byprio = self.observers.setdefault(event.upper(), {})
+            byprio.setdefault(func.priority, []).append(func)
     
     COMMAND_DEFAULTS = {
         'priority' : 'medium',
@@ -195,6 +232,13 @@ class Phenny(irc.Bot):
         }
     def bind_commands(self): 
         self.commands = {'high': {}, 'medium': {}, 'low': {}}
+        self.index = {'high': {}, 'medium': {}, 'low': {}}
+        self.observers = {}
+        
+        # Used to pull the command word out of a line. This is compiled the 
+        # same way as the command patterns, so it sees the prefix the same way.
+        self.commandword = re.compile(self.config.prefix + r'(\w+)')
+        self.foldcommands = bool(self.commandword.flags & re.IGNORECASE)
         
         for name, func in self.variables.iteritems(): 
 #            print name, func
@@ -204,6 +248,10 @@ class Phenny(irc.Bot):
             
             func.event = func.event.upper()
             
+            # Observers see every line of an event, e.g. observe = 'PRIVMSG'
+            if hasattr(func, 'observe'): 
+                self.bind_observer(func)
+            
             if hasattr(func, 'rule'): 
                 if isinstance(func.rule, str): 
                     pattern = self.subnick(func.rule)
@@ -223,9 +271,9 @@ class Phenny(irc.Bot):
                         prefix = self.config.prefix
                         commands, pattern = func.rule
                         for command in commands: 
-                            command = r'(%s)\b(?: +(?:%s))?' % (command, pattern)
-                            regexp = re.compile(prefix + command)
-                            self.bind_func(func.priority, regexp, func)
+                            cmdpattern = r'(%s)\b(?: +(?:%s))?' % (command, pattern)
+                            regexp = re.compile(prefix + cmdpattern)
+                            self.bind_func(func.priority, regexp, func, command)
                         
                     # 3) e.g. ('$nick', ['p', 'q'], '(.*)')
                     elif len(func.rule) == 3: 
@@ -241,7 +289,13 @@ class Phenny(irc.Bot):
                     template = r'^%s(%s)(?: +(.*))?$'
                     pattern = template % (self.config.prefix, command)
                     regexp = re.compile(pattern)
-                    self.bind_func(func.priority, regexp, func)
+                    self.bind_func(func.priority, regexp, func, command)
+        
+        # Observers run alongside the handlers of their priority, in a fixed 
+        # order within it
+        for byprio in self.observers.itervalues(): 
+            for funcs in byprio.itervalues(): 
+                funcs.sort(key=lambda f: (f.__module__, f.name))
     
 ####################
 # COMMAND DISPATCH #
@@ -253,14 +307,31 @@ class Phenny(irc.Bot):
     def input(self, origin, text, bytes, match, event, args): 
         return self.CommandInput(self, text, origin, bytes, match, event, args)
     
-    def call(self, func, origin, phenny, input): 
+    def pipeline(self, funcs, origin, phenny, input, queued=None): 
+        for func in funcs: 
+            self.call(func, origin, phenny, input, queued)
+    
+    def call(self, func, origin, phenny, input, queued=None): 
+        start = time.time()
+        perf = self.handlerstats(func.name)
+        with self.perflock: 
+            perf.inflight += 1
+            if queued is not None: 
+                perf.wait.add(start - queued)
         try: 
             func(phenny, input)
         except KeyboardInterrupt:
             raise
         except Exception, e: 
+            with self.perflock: 
+                perf.errors += 1
             traceback.print_exc()
             self.error(origin)
+        finally: 
+            with self.perflock: 
+                perf.inflight -= 1
+                perf.calls += 1
+                perf.time.add(time.time() - start)
     
     def limit(self, origin, func): 
        if origin.sender and origin.sender.startswith('#'): 
@@ -270,9 +341,11 @@ class Phenny(irc.Bot):
                    return True
        return False
     
-    def dispatch(self, origin, args): 
-        bytes, event, args = args[0], args[1], args[2:]
-        text = decode(bytes)
+    def dispatch(self, origin): 
+        # The irc.Message is the origin, and is shared by every handler
+        start = time.time()
+        bytes, event, args = origin.trailing, origin.command, origin.params
+        text = origin.text
         if os.environ.get('SHOW_DISPATCH'):
             print "Dispatch: %r %r %r %r" % (event, args, origin, text)
         
@@ -281,33 +354,108 @@ class Phenny(irc.Bot):
             #args[0] is the origin of the message as reported by IRC
             self.activity[args[0]] = (time.time(), origin)
         
-        for priority in ('high', 'medium', 'low'): 
-            items = self.commands[priority].items()
-            for regexp, funcs in items: 
-                for func in funcs: 
-                    if event != func.event: 
+        # Only the handlers filed under the line's command word (if any) and 
+        # the free-form rules can possibly match, so only those are tried.
+        word = None
+        m = self.commandword.match(text)
+        if m: 
+            word = m.group(m.re.groups)
+            if self.foldcommands: 
+                word = word.lower()
+        
+        observers = self.observers.get(event, {})
+        shared = None # The input every observer of this line gets
+        for priority in PRIORITIES: 
+            try: 
+                words, rules = self.index[priority][event]
+            except KeyError: 
+                candidates = []
+            else: 
+                if word is not None and word in words: 
+                    candidates = words[word] + rules
+                else: 
+                    candidates = rules
+            
+            for regexp, func in candidates: 
+                match = regexp.match(text)
+                if match: 
+                    if self.limit(origin, func):
+                        print "Limited!" 
                         continue
                     
-                    match = regexp.match(text)
-                    if match: 
-                        if self.limit(origin, func):
-                            print "Limited!" 
-                            continue
-                        
-                        phenny = self.wrapped(origin, text, match)
-                        input = self.input(origin, text, bytes, match, event, args)
-                        
-                        if func.thread: 
-                            startdaemon(self.call, func, origin, phenny, input)
-                        else:
-                            self.call(func, origin, phenny, input)
-                        
-                        for source in [origin.sender, origin.nick]: 
-                            # XXX: Should this be moved to a service module?
-                            try: 
-                                self.stats[(func.name, source)] += 1
-                            except KeyError: 
-                                self.stats[(func.name, source)] = 1
+                    phenny = self.wrapped(origin, text, match)
+                    input = self.input(origin, text, bytes, match, event, args)
+                    
+                    if func.thread: 
+                        self.pool.submit(func.__module__, self.call, func, origin, phenny, input, time.time())
+                    else:
+                        self.call(func, origin, phenny, input)
+                    
+                    self.count(func, origin)
+            
+            funcs = observers.get(priority)
+            if funcs: 
+                if shared is None: 
+                    match = r_observed.match(text)
+                    shared = (self.wrapped(origin, text, match), 
+                              self.input(origin, text, bytes, match, event, args))
+                self.notify(funcs, origin, *shared)
+        
+        perf = self.handlerstats('(dispatch)')
+        with self.perflock: 
+            perf.calls += 1
+            perf.time.add(time.time() - start)
+    
+    def notify(self, observers, origin, phenny, input): 
+        """
+        Passes a line to some of its observers. They all share one input, and 
+        the threaded ones from each module run one after the other as a job 
+        of that module's, so a slow module only holds up itself.
+        """
+        threaded = {} # module -> [func]
+        modules = []
+        for func in observers: 
+            if self.limit(origin, func): 
+                continue
+            if func.thread: 
+                if func.__module__ not in threaded: 
+                    modules.append(func.__module__)
+                threaded.setdefault(func.__module__, []).append(func)
+            else: 
+                self.call(func, origin, phenny, input)
+            self.count(func, origin)
+        
+        for module in modules: 
+            self.pool.submit(module, self.pipeline, threaded[module], origin, phenny, input, time.time())
+    
+    def handlerstats(self, name): 
+        try: 
+            return self.perf[name]
+        except KeyError: 
+            return self.perf.setdefault(name, HandlerStats())
+    
+    def perfreport(self): 
+        """p.perfreport() -> dict
+        Returns the performance figures for every handler and the worker pool, 
+        in a form that can be dumped as JSON.
+        """
+        with self.perflock: 
+            handlers = dict((name, perf.todict()) for name, perf in self.perf.iteritems())
+        return {
+            'time': time.time(),
+            'handlers': handlers,
+            'pool': self.pool.stats(),
+            'sender': self.sender.stats(),
+            'web': web.stats(),
+            }
+    
+    def count(self, func, origin): 
+        for source in [origin.sender, origin.nick]: 
+            # XXX: Should this be moved to a service module?
+            try: 
+                self.stats[(func.name, source)] += 1
+            except KeyError: 
+                self.stats[(func.name, source)] = 1
     
 ########################
 # SERVICE MODULE HOOKS #
@@ -344,6 +492,9 @@ class Phenny(irc.Bot):
     def save_storage(self):
         print >> sys.stderr, "Saving storage..."
         for module in self.modules:
+            if hasattr(module, 'flush'):
+                # Modules that hold on to changes get to write them out first
+                module.flush(self)
             if hasattr(module, 'storage') and hasattr(module.storage, 'flush'):
                 #Save the data
                 module.storage.flush()
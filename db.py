@@ -0,0 +1,147 @@
+"""
+Shared SQLite databases for modules.
+
+sqlite3 connections can't be passed between threads, so rather than opening
+a new one for every query, each thread that touches a database gets its own
+long-lived connection, which keeps its prepared statements cached.
+"""
+import os, sqlite3, threading, atexit
+from contextlib import contextmanager
+
+__all__ = ['Database', 'open']
+
+class Database(object):
+    """
+    A SQLite database, usable from any thread.
+
+    Statements run in autocommit mode unless they're inside transaction(),
+    which is also the way to batch several writes into one commit. Rows come
+    back as sqlite3.Row, so they can be used as tuples or by column name.
+
+    With wal (the default), the database is switched to write-ahead logging,
+    so readers don't block the writer or each other, and only syncs at
+    checkpoints. Pass wal=False to leave the journal mode of an existing file
+    alone.
+
+    Every connection is closed when the interpreter exits. (Left to be freed
+    along with the daemon threads that own them, they can crash it on the way
+    out.)
+    """
+    def __init__(self, path, wal=True, statements=100):
+        self.path = path
+        self.wal = wal
+        self.statements = statements
+        self._local = threading.local()
+        self._conns = [] # Every thread's, for closeall()
+        self._conns_lock = threading.Lock()
+
+    def connection(self):
+        """db.connection() -> sqlite3.Connection
+        Returns this thread's connection, opening it if needed.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+                cached_statements=self.statements)
+            conn.row_factory = sqlite3.Row
+            if self.wal:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def cursor(self):
+        return self.connection().cursor()
+
+    def execute(self, sql, params=()):
+        """db.execute(str, [sequence|dict]) -> sqlite3.Cursor
+        """
+        return self.connection().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.connection().executemany(sql, seq)
+
+    def executescript(self, sql):
+        return self.connection().executescript(sql)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in a transaction, committing at the end or rolling back
+        if it raises. Yields a cursor. Transactions can be nested; only the
+        outermost one commits.
+        """
+        conn = self.connection()
+        cursor = conn.cursor()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield cursor
+            finally:
+                self._local.depth -= 1
+            return
+
+        # Take the write lock up front, so we can't deadlock upgrading to it
+        cursor.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield cursor
+        except:
+            self._local.depth = 0
+            cursor.execute("ROLLBACK")
+            raise
+        else:
+            self._local.depth = 0
+            cursor.execute("COMMIT")
+
+    def close(self):
+        """
+        Closes this thread's connection, if it has one.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            with self._conns_lock:
+                if conn in self._conns:
+                    self._conns.remove(conn)
+            conn.close()
+            self._local.conn = None
+
+    def closeall(self):
+        """
+        Closes every thread's connection. Only for shutting down: a thread that
+        carries on using its connection gets errors.
+        """
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+_databases = {}
+_lock = threading.Lock()
+
+def open(path, wal=True):
+    """open(str, [bool]) -> Database
+    Returns the Database for the file, so that every module using the same
+    file shares it.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    with _lock:
+        try:
+            return _databases[path]
+        except KeyError:
+            db = _databases[path] = Database(path, wal)
+            return db
+
+@atexit.register
+def closeall():
+    with _lock:
+        databases = _databases.values()
+    for db in databases:
+        db.closeall()
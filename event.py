@@ -1,7 +1,7 @@
 """
 Defines a mix-in class for events.
 """
-import threading, traceback
+import sys, threading, traceback
 from tools import startdaemon
 
 class EventSource(object):
@@ -10,6 +10,7 @@ class EventSource(object):
     to subscribe to.
     """
     __calls = None
+    pool = None # The tools.WorkerPool to run threaded callbacks on, if any
     def __init__(self, *p, **kw):
         super(EventSource, self).__init__(*p, **kw)
         self.__calls = {}
@@ -17,7 +18,8 @@ class EventSource(object):
     def connect(self, event, func, thread=True):
         """es.connect(str, callable, [bool])
         Registers your callback against the named event. If thread is True, the 
-        callback will be called in a new thread.
+        callback will be called in another thread (from the pool, if there is 
+        one).
         """
         event = str(event)
         e = self.__calls.setdefault(event, {})
@@ -45,7 +47,11 @@ class EventSource(object):
         
         for func, thread in calls.items():
             if thread:
-                startdaemon(func, self, *p, **kw)
+                if self.pool is not None:
+                    key = getattr(func, '__module__', None)
+                    self.pool.submit(key, func, self, *p, **kw)
+                else:
+                    startdaemon(func, self, *p, **kw)
             else:
                 try:
                     func(self, *p, **kw)
@@ -11,29 +11,232 @@ import sys, re, time, traceback
 import socket, asyncore
 import asynchat2 as asynchat
 import threading, os
+from collections import deque, OrderedDict
+from tools import DaemonThread
 
-class Origin(object): 
-   source = re.compile(r'([^!]*)!?([^@]*)@?(.*)')
-
-   def __init__(self, bot, source, args): 
-      match = Origin.source.match(source or '')
-      self.nick, self.user, self.host = match.groups()
+def decode(bytes): 
+   try: text = bytes.decode('utf-8')
+   except UnicodeDecodeError: 
+      try: 
+         text = bytes.decode('iso-8859-1')
+      except UnicodeDecodeError: 
+         text = bytes.decode('cp1252')
+   return text
+
+r_tagescape = re.compile(r'\\(.?)')
+tagescapes = {':': ';', 's': ' ', 'r': '\r', 'n': '\n'}
+
+class Message(object): 
+   """
+   A line from the server, parsed once. Everything that handles the line 
+   shares the one object, which also serves as its origin (nick, user, host 
+   and sender).
+   """
+   __slots__ = ('prefix', 'command', 'params', 'trailing', 'sender', 
+                '_tags', '_text', '_nick', '_user', '_host')
+
+   def __init__(self, bot, line): 
+      if line.startswith('@'): 
+         tags, _, line = line[1:].partition(' ')
+      else: tags = None
 
-      if len(args) > 1: 
-         target = args[1]
-      else: target = None
+      if line.startswith(':'): 
+         prefix, _, line = line[1:].partition(' ')
+      else: prefix = None
 
-      mappings = {bot.nick: self.nick, None: None}
-      self.sender = mappings.get(target, target)
-   
-   def __repr__(self):
-        return "<irc.Origin nick=%(nick)r user=%(user)r host=%(host)r sender=%(sender)r>" % vars(self)
+      if ' :' in line: 
+         argstr, trailing = line.split(' :', 1)
+      else: argstr, trailing = line, ''
+      params = argstr.split()
+
+      if params: 
+         command = intern(params.pop(0))
+      else: command = ''
+      if params and params[0][0] in '#&': 
+         params[0] = intern(params[0])
+
+      self.prefix = prefix
+      self.command = command
+      self.params = tuple(params)
+      self.trailing = trailing
+      self._tags = tags
+      self._text = self._nick = self._user = self._host = None
+
+      target = params[0] if params else None
+      if target == bot.nick: 
+         self.sender = self.nick
+      else: self.sender = target
+
+   def _split(self): 
+      nick, bang, rest = (self.prefix or '').partition('!')
+      if bang: 
+         user, _, host = rest.partition('@')
+      else: user = host = ''
+      self._nick, self._user, self._host = nick, user, host
+
+   @property
+   def nick(self): 
+      if self._nick is None: 
+         self._split()
+      return self._nick
+
+   @property
+   def user(self): 
+      if self._user is None: 
+         self._split()
+      return self._user
+
+   @property
+   def host(self): 
+      if self._host is None: 
+         self._split()
+      return self._host
+
+   @property
+   def text(self): 
+      """The trailing parameter, decoded."""
+      if self._text is None: 
+         self._text = decode(self.trailing)
+      return self._text
+
+   @property
+   def tags(self): 
+      """The IRCv3 message tags, as a dict."""
+      if not isinstance(self._tags, dict): 
+         tags = {}
+         for tag in (self._tags or '').split(';'): 
+            if not tag: continue
+            key, _, value = tag.partition('=')
+            tags[key] = r_tagescape.sub(
+               lambda m: tagescapes.get(m.group(1), m.group(1)), value)
+         self._tags = tags
+      return self._tags
+
+   def __repr__(self): 
+      return "<irc.Message %s %r nick=%r sender=%r %r>" % \
+         (self.command, self.params, self.nick, self.sender, self.trailing)
+
+CONTROL, CHAT = 'control', 'chat'
+
+# Sent straight out, without waiting on (or paying into) flood control: 
+# registration, and answers to pings, which get us disconnected if late
+UNMETERED = frozenset(['PONG', 'PASS', 'NICK', 'USER', 'CAP'])
+
+class Sender(object): 
+   """
+   Paces everything we send to the server, so we don't get kicked for 
+   flooding, without making anybody who sends wait.
+
+   Flood control is a token bucket measured in seconds: every line costs 
+   base seconds, plus a second for every length bytes past the first 50, and 
+   the bucket refills at one second per second up to burst. (The defaults 
+   match the old rule of 0.8 seconds between lines plus a length penalty, 
+   unless nothing was sent in the last 3 seconds.)
+
+   There are two lanes. Control traffic (MODE, JOIN, talking to services, 
+   ...) always goes first. Chat is queued per target and the 
+   targets take turns, so one long reply doesn't hold up everyone else.
+   """
+   def __init__(self, write, burst=3.0, base=0.8, length=70.0): 
+      self.write = write
+      self.burst = burst
+      self.base = base
+      self.length = length
+      self.tokens = burst
+      self.stamp = time.time()
+      self.control = deque()
+      self.chat = OrderedDict() # target -> deque of lines
+      self.sent = 0
+      self.cond = threading.Condition()
+      self.thread = None
+
+   def configure(self, options): 
+      with self.cond: 
+         self.burst = options.get('burst', self.burst)
+         self.base = options.get('base', self.base)
+         self.length = options.get('length', self.length)
+         self.tokens = min(self.tokens, self.burst)
+
+   def cost(self, text): 
+      return self.base + float(max(0, len(text or '') - 50)) / self.length
+
+   def queue(self, args, text=None, lane=CHAT): 
+      """s.queue(tuple, [str], [str])
+      Queues a line to be sent. Never blocks.
+      """
+      with self.cond: 
+         if lane == CONTROL: 
+            self.control.append((args, text))
+         else: 
+            target = args[1].lower() if len(args) > 1 else None
+            self.chat.setdefault(target, deque()).append((args, text))
+         if self.thread is None: 
+            self.thread = DaemonThread(target=self.run, name='Sender')
+            self.thread.start()
+         self.cond.notify()
+
+   def _peek(self): 
+      if self.control: 
+         return self.control, None
+      for target, lines in self.chat.iteritems(): 
+         return lines, target
+      return None, None
+
+   def run(self): 
+      while True: 
+         with self.cond: 
+            lines, target = self._peek()
+            if lines is None: 
+               self.cond.wait()
+               continue
+
+            args, text = lines[0]
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp))
+            self.stamp = now
+            cost = self.cost(text)
+            if self.tokens < cost: 
+               # Something more urgent may turn up while we wait
+               self.cond.wait(cost - self.tokens)
+               continue
+
+            self.tokens -= cost
+            lines.popleft()
+            if target is not None: 
+               # Send this target to the back of the line
+               del self.chat[target]
+               if lines: 
+                  self.chat[target] = lines
+            self.sent += 1
+
+         try: self.write(args, text)
+         except Exception: 
+            # Don't let one bad line stop everything after it
+            traceback.print_exc()
+
+   def stats(self): 
+      with self.cond: 
+         return {
+            'control': len(self.control), 
+            'chat': sum(len(l) for l in self.chat.itervalues()), 
+            'targets': len(self.chat), 
+            'tokens': self.tokens, 
+            'sent': self.sent, 
+            }
 
 class Bot(asynchat.async_chat): 
+   # How much we ask for from the socket at once grows while reads keep 
+   # filling it (a big NAMES reply, or a burst after connecting) and shrinks 
+   # again when they don't
+   min_recv_size = 4096
+   max_recv_size = 65536
+
    def __init__(self, nick, name, channels, password=None): 
       asynchat.async_chat.__init__(self)
       self.set_terminator('\n')
       self.buffer = ''
+      self.inbuf = bytearray()
+      self.recv_size = self.min_recv_size
 
       self.nick = nick
       self.user = nick
@@ -45,6 +248,13 @@ class Bot(asynchat.async_chat):
       self.stack = []
 
       self.sending = threading.RLock()
+      self.sendlock = threading.RLock()
+      self.sender = Sender(self.__write)
+
+      self.wantcaps = set() # Capabilities to ask for, if the server has them
+      self.caps = set() # Capabilities the server has turned on for us
+      self.lscaps = set()
+      self.isupport = {} # From RPL_ISUPPORT (005)
 
    def __write(self, args, text=None): 
       # print '%r %r %r' % (self, args, text)
@@ -56,7 +266,8 @@ class Bot(asynchat.async_chat):
          pass
 
    def write(self, args, text=None): 
-      # This is a safe version of __write
+      # This is a safe version of __write. NOTICEs wait their turn with 
+      # PRIVMSGs, and most of the rest goes in the control lane.
       def safe(input): 
          input = input.replace('\n', '')
          input = input.replace('\r', '')
@@ -65,7 +276,11 @@ class Bot(asynchat.async_chat):
          args = [safe(arg) for arg in args]
          if text is not None: 
             text = safe(text)
-         self.__write(args, text)
+         if args[0] in UNMETERED: 
+            self.__write(args, text)
+         elif args[0] == 'NOTICE' and not args[1].lower().endswith('serv'): 
+            self.sender.queue(args, text, CHAT)
+         else: self.sender.queue(args, text, CONTROL)
       except Exception, e: pass
 
    def run(self, host, port=6667): 
@@ -84,6 +299,8 @@ class Bot(asynchat.async_chat):
    def handle_connect(self): 
       if self.verbose: 
          print >> sys.stderr, 'connected!'
+      if self.wantcaps: 
+         self.write(('CAP', 'LS', '302'))
       if self.password: 
          self.write(('PASS', self.password))
       self.write(('NICK', self.nick))
@@ -93,37 +310,106 @@ class Bot(asynchat.async_chat):
       self.close()
       print >> sys.stderr, 'Closed!'
 
+   def initiate_send(self): 
+      # The sender thread pushes while the asyncore loop writes out what's
+      # left over; unguarded, both can send (and drop) the same line
+      with self.sendlock:
+         asynchat.async_chat.initiate_send(self)
+
+   def handle_read(self): 
+      # Unlike async_chat's, this splits every complete line out of what 
+      # has been read in one go, and hands them over as a batch
+      try: 
+         data = self.recv(self.recv_size)
+      except socket.error, why: 
+         self.handle_error()
+         return
+
+      if len(data) >= self.recv_size: 
+         self.recv_size = min(self.recv_size * 2, self.max_recv_size)
+      elif len(data) < self.recv_size / 4: 
+         self.recv_size = max(self.recv_size / 2, self.min_recv_size)
+
+      inbuf = self.inbuf
+      inbuf.extend(data)
+      end = inbuf.rfind('\n')
+      if end == -1: 
+         return
+
+      lines = str(buffer(inbuf, 0, end)).split('\n')
+      del inbuf[:end + 1]
+      self.found_lines(lines)
+
    def collect_incoming_data(self, data): 
       self.buffer += data
 
    def found_terminator(self): 
       line = self.buffer
-      if line.endswith('\r'): 
-         line = line[:-1]
       self.buffer = ''
+      self.process_line(line)
 
-      # print line
-      if line.startswith(':'): 
-         source, line = line[1:].split(' ', 1)
-      else: source = None
+   def found_lines(self, lines): 
+      for line in lines: 
+         self.process_line(line)
 
-      if ' :' in line: 
-         argstr, text = line.split(' :', 1)
-      else: argstr, text = line, ''
-      args = argstr.split()
+   def process_line(self, line): 
+      if line.endswith('\r'): 
+         line = line[:-1]
 
-      origin = Origin(self, source, args)
-      self.dispatch(origin, tuple([text] + args))
+      # print line
+      message = Message(self, line)
+      if message.command == 'CAP': 
+         self.handle_cap(message)
+      elif message.command == '005': 
+         self.handle_isupport(message)
+      self.dispatch(message)
 
-      if args[0] == 'PING': 
-         self.write(('PONG', text))
+      if message.command == 'PING': 
+         self.write(('PONG', message.trailing))
 
-   def dispatch(self, origin, args): 
+   def dispatch(self, message): 
       pass
 
-   def msg(self, recipient, text): 
-      self.sending.acquire()
+   def request_caps(self, *caps): 
+      """b.request_caps(str, ...)
+      Asks for IRCv3 capabilities when we connect. The ones the server 
+      agrees to end up in b.caps.
+      """
+      self.wantcaps.update(caps)
+
+   def handle_cap(self, message): 
+      if len(message.params) < 2: 
+         return
+      subcommand = message.params[1]
+      offered = set(c.split('=', 1)[0] for c in message.trailing.split())
+      if subcommand == 'LS': 
+         self.lscaps |= offered
+         if len(message.params) > 2 and message.params[2] == '*': 
+            return # More to come
+         wanted = self.wantcaps & self.lscaps
+         self.lscaps = set()
+         if wanted: 
+            self.write(('CAP', 'REQ'), ' '.join(sorted(wanted)))
+         else: self.write(('CAP', 'END'))
+      elif subcommand == 'ACK': 
+         for cap in offered: 
+            if cap.startswith('-'): 
+               self.caps.discard(cap[1:])
+            else: self.caps.add(cap)
+         self.write(('CAP', 'END'))
+      elif subcommand == 'NAK': 
+         self.write(('CAP', 'END'))
+
+   def handle_isupport(self, message): 
+      # The first parameter is our nick, the trailing one is prose
+      for token in message.params[1:]: 
+         if token.startswith('-'): 
+            self.isupport.pop(token[1:], None)
+            continue
+         key, eq, value = token.partition('=')
+         self.isupport[key] = value if eq else True
 
+   def msg(self, recipient, text): 
       # Cf. http://swhack.com/logs/2006-03-01#T19-43-25
       if isinstance(text, unicode): 
          try: text = text.encode('utf-8')
@@ -134,29 +420,23 @@ class Bot(asynchat.async_chat):
          except UnicodeEncodeError, e: 
             return
 
-      # No messages within the last 3 seconds? Go ahead!
-      # Otherwise, wait so it's been at least 0.8 seconds + penalty
-      if self.stack: 
-         elapsed = time.time() - self.stack[-1][0]
-         if elapsed < 3: 
-            penalty = float(max(0, len(text) - 50)) / 70
-            wait = 0.8 + penalty
-            if elapsed < wait: 
-               time.sleep(wait - elapsed)
-
-      # Loop detection
-      messages = [m[1] for m in self.stack[-8:]]
-      if messages.count(text) >= 5: 
-         text = 'Error!  Too many requests!'
-         if messages.count('Error!  Too many requests!') >= 3: 
-            self.sending.release()
-            return
-
-      self.__write(('PRIVMSG', recipient), text)
-      self.stack.append((time.time(), text))
-      self.stack = self.stack[-10:]
-
-      self.sending.release()
+      # Flood control is the sender's job, this just queues
+      with self.sending: 
+         # Loop detection
+         messages = [m[1] for m in self.stack[-8:]]
+         if messages.count(text) >= 5: 
+            text = 'Error!  Too many requests!'
+            if messages.count('Error!  Too many requests!') >= 3: 
+               return
+
+         self.stack.append((time.time(), text))
+         self.stack = self.stack[-10:]
+
+      # Services get answered ahead of chatter
+      if recipient.lower().endswith('serv'): 
+         lane = CONTROL
+      else: lane = CHAT
+      self.sender.queue(('PRIVMSG', recipient), text, lane)
 
    def notice(self, dest, text): 
       self.write(('NOTICE', dest), text)
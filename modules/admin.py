@@ -159,14 +159,18 @@ def auth_request(phenny, input):
   """
   This will scan every message in a room for nicks in phenny's
   admin list.  If one is found, it will send an ACC request
-  to NickServ.  May only work with Freenode.
+  to NickServ (through nicktracker's queue, if it's loaded, so
+  repeated requests are collapsed).  May only work with Freenode.
   """
   admins = phenny.config.admins
   pattern = '(' + '|'.join([re.escape(x) for x in admins]) + ')'
   matches = re.findall(pattern, input)
   for x in matches:
-    phenny.msg('NickServ', 'ACC ' + x)
-auth_request.rule = r'.*'
+    if hasattr(phenny, 'nicktracker'):
+      phenny.nicktracker.query(x)
+    else:
+      phenny.msg('NickServ', 'ACC ' + x)
+auth_request.observe = 'PRIVMSG'
 auth_request.priority = 'high'
 
 def auth_verify(phenny, input):
@@ -192,7 +196,7 @@ def auth_verify(phenny, input):
     else:
       auth_list.remove(nick)
 auth_verify.event = 'NOTICE'
-auth_verify.rule = r'(\S+) (ACC) ([0-3])'
+auth_verify.rule = r'(\S+)(?: -> \S+)? (ACC) ([0-3])'
 auth_verify.priority = 'high'
 
 def auth_check(phenny, nick, target=None):
@@ -216,18 +220,15 @@ def deauth(nick):
 
 def deauth_quit(phenny, input):
   deauth(input.nick)
-deauth_quit.event = 'QUIT'
-deauth_quit.rule = '.*'
+deauth_quit.observe = 'QUIT'
 
 def deauth_part(phenny, input):
   deauth(input.nick)
-deauth_part.event = 'PART'
-deauth_part.rule = '.*'
+deauth_part.observe = 'PART'
 
 def deauth_nick(phenny, input):
   deauth(input.nick)
-deauth_nick.event = 'NICK'
-deauth_nick.rule = '.*'
+deauth_nick.observe = 'NICK'
 
 def kick(phenny, input):
   if not input.admin: return
@@ -7,7 +7,8 @@ Licensed under the Eiffel Forum License 2.
 http://inamidst.com/phenny/
 """
 
-import re, math, time, urllib, locale, socket, struct, datetime
+import re, math, time, locale, socket, struct, datetime
+import web
 from decimal import Decimal as dec
 from tools import deprecated
 
@@ -274,12 +275,16 @@ def yi(phenny, input):
 yi.commands = ['yi']
 yi.priority = 'low'
 
+r_usno = re.compile(r'(?im)^<BR>\s*(.*?\bUTC)\b')
+
 def tock(phenny, input): 
    """Shows the time from the USNO's atomic clock."""
-   u = urllib.urlopen('http://tycho.usno.navy.mil/cgi-bin/timer.pl')
-   info = u.info()
-   u.close()
-   phenny.say('"' + info['Date'] + '" - tycho.usno.navy.mil')
+   # Never from the cache: it's the time now that's wanted
+   bytes = web.get('http://tycho.usno.navy.mil/cgi-bin/timer.pl', ttl=0)
+   m = r_usno.search(bytes or '')
+   if not m: 
+      return phenny.say("Couldn't read the time from tycho.usno.navy.mil")
+   phenny.say('"' + m.group(1) + '" - tycho.usno.navy.mil')
 tock.commands = ['tock']
 tock.priority = 'high'
 
@@ -32,7 +32,7 @@ def dict(phenny, input):
          thing = thing[:-6]
       return thing.strip(' :.')
 
-   bytes = web.get(uri % word)
+   bytes = web.get(uri % word, ttl=24*60*60)
    results = {}
    wordkind = None
    for kind, sense in r_info.findall(bytes): 
@@ -46,7 +46,7 @@ def etymology(word):
       raise ValueError("Word too long: %s[...]" % word[:10])
    word = {'axe': 'ax/axe'}.get(word, word)
 
-   bytes = web.get(etyuri % word)
+   bytes = web.get(etyuri % word, ttl=24*60*60)
    definitions = r_definition.findall(bytes)
 
    if not definitions: 
@@ -76,8 +76,7 @@ def join_greeter(phenny, input):
         if random.randint(1,100) <= int(ginfo['chance']):
             phenny.say(random.choice(ginfo['greets']))
 
-join_greeter.event = 'JOIN'
-join_greeter.rule = r'(.*)'
+join_greeter.observe = 'JOIN'
 join_greeter.priority = 'low'
 
 
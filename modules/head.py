@@ -7,7 +7,7 @@ Licensed under the Eiffel Forum License 2.
 http://inamidst.com/phenny/
 """
 
-import re, urllib, urllib2, httplib, urlparse, time
+import re, urllib, httplib, time
 from htmlentitydefs import name2codepoint
 import web
 from tools import deprecated
@@ -68,46 +68,27 @@ def head(phenny, input):
 head.commands = ['head']
 head.example = '.head http://www.w3.org/'
 
+# Links are often through a few shorteners and trackers
+TITLE_REDIRECTS = 25
+
 r_title = re.compile(r'(?ims)<title[^>]*>(.*?)</title\s*>')
 r_entity = re.compile(r'&[A-Za-z0-9#]+;')
 
 def gettitle(uri):
-    #print "Getting title: %r" % uri
-    redirects = 0
-    while True: 
-        headers = {
-            'Accept': 'text/html', 
-            'User-Agent': 'Mozilla/5.0 (Phenny)'
-        }
-        req = urllib2.Request(uri, headers=headers)
-        u = urllib2.urlopen(req)
-        info = u.info()
-        u.close()
-        # info = web.head(uri)
-
-        if not isinstance(info, list): 
-            status = '200'
-        else: 
-            status = str(info[1])
-            info = info[0]
-        if status.startswith('3'): 
-            uri = urlparse.urljoin(uri, info['Location'])
-        else: break
-
-        redirects += 1
-        if redirects >= 25: 
-            return Ellipsis
-
-    try: mtype = info['content-type']
-    except: 
-        err = "Couldn't get the Content-Type, sorry"
-        return self.reply(err)
-    if not (('/html' in mtype) or ('/xhtml' in mtype)): 
-        return None
+    # The same link pasted in several channels only gets fetched once
+    return web.coalesce(('title', web.normalize(uri)), fetchtitle, uri)
 
-    u = urllib2.urlopen(req)
-    bytes = u.read(262144) #256K
-    u.close()
+def fetchtitle(uri):
+    #print "Getting title: %r" % uri
+    try: 
+        u = web.request(uri, headers={'Accept': 'text/html'}, redirects=TITLE_REDIRECTS)
+    except web.TooManyRedirects: 
+        return Ellipsis
+    with u: 
+        mtype = u.headers.get('content-type')
+        if not mtype or not (('/html' in mtype) or ('/xhtml' in mtype)): 
+            return None
+        bytes = u.read(262144) #256K
 
     m = r_title.search(bytes)
     if m: 
@@ -178,11 +159,9 @@ def f_title(phenny, input):
             phenny.reply(title)
 f_title.commands = ['title']
 
-# We do this seperately so that we can add config options later
-def showtitle(phenny, input):
-    uri = input.group(1)
-    if input.startswith('.title'):
-        return
+r_uri = re.compile(r'.*(http[s]?://[^<> "\x01]+)[,.]?')
+
+def announcetitle(phenny, uri):
     try: 
         title = gettitle(uri)
     except IOError: 
@@ -193,14 +172,26 @@ def showtitle(phenny, input):
         elif title == '': pass
         else:
             phenny.say('Title: %s' % title)
-showtitle.rule = r'.*(http[s]?://[^<> "\x01]+)[,.]?'
+
+# We do this seperately so that we can add config options later
+def showtitle(phenny, input):
+    m = r_uri.match(input)
+    if not m: 
+        return
+    if input.startswith('.title'):
+        return
+    # Don't hold up the other observers while we fetch
+    phenny.pool.submit(__name__, announcetitle, phenny, m.group(1))
+showtitle.observe = 'PRIVMSG'
 showtitle.priority = 'low'
 
 def noteuri(phenny, input): 
    global storage
-   uri = input.group(1)
-   storage[input.sender] = uri
-noteuri.rule = r'.*(http[s]?://[^<> "\x01]+)[,.]?'
+   m = r_uri.match(input)
+   if not m: 
+      return
+   storage[input.sender] = m.group(1)
+noteuri.observe = 'PRIVMSG'
 noteuri.priority = 'low'
 
 if __name__ == '__main__': 
@@ -7,6 +7,28 @@ Licensed under the Eiffel Forum License 2.
 http://inamidst.com/phenny/
 """
 
+import os, json
+
+def setup(phenny): 
+   # Periodically dump the performance figures for other tools to read
+   config = getattr(phenny.config, 'perf', {})
+   interval = config.get('interval', 300)
+   if not interval: return
+   fn = os.path.expanduser(config.get('dump', '~/.phenny/perf.json'))
+
+   def dump(): 
+      try: dumpperf(phenny, fn)
+      except Exception, e: 
+         print "Couldn't dump performance figures: %s" % e
+
+   phenny.timers.every(interval, dump)
+
+def dumpperf(phenny, fn): 
+   tmp = fn + '.tmp'
+   with open(tmp, 'w') as f: 
+      json.dump(phenny.perfreport(), f, indent=1, sort_keys=True)
+   os.rename(tmp, fn)
+
 def doc(phenny, input): 
    """Shows a command's documentation, and possibly an example."""
    name = input.group(1)
@@ -85,5 +107,53 @@ def stats(phenny, input):
 stats.commands = ['stats']
 stats.priority = 'low'
 
+def ms(seconds): 
+   if seconds is None: return '-'
+   return '%.0fms' % (seconds * 1000)
+
+def perf(phenny, input): 
+   """Show handler latency figures. This is an admin-only command."""
+   if not input.admin: return
+   report = phenny.perfreport()
+   handlers = report['handlers']
+
+   name = input.group(2)
+   if name: 
+      if name not in handlers: 
+         return phenny.reply('No figures for %s.' % name)
+      h = handlers[name]
+      phenny.reply(('%s: %i calls, %i errors, %i running; time p50 %s, ' + 
+         'p90 %s, p99 %s, max %s; queue wait p50 %s, p99 %s') % (name, 
+         h['calls'], h['errors'], h['inflight'], ms(h['time']['p50']), 
+         ms(h['time']['p90']), ms(h['time']['p99']), ms(h['time']['max']), 
+         ms(h['wait']['p50']), ms(h['wait']['p99'])))
+      return
+
+   # The handlers eating the most time
+   ranked = sorted(handlers.iteritems(), key=lambda i: -i[1]['time']['total'])
+   reply = 'slowest handlers: '
+   for name, h in ranked[:8]: 
+      reply += '%s (%i, p99 %s), ' % (name, h['calls'], ms(h['time']['p99']))
+   phenny.say(reply.rstrip(', '))
+
+   errors = sorted((h['errors'], name) for name, h in handlers.iteritems() if h['errors'])
+   if errors: 
+      phenny.say('errors: ' + ', '.join('%s (%i)' % (n, c) for c, n in reversed(errors[-8:])))
+
+   pool = report['pool']
+   phenny.say(('workers: %(busy)i/%(threads)i busy, %(depth)i queued ' + 
+      '(max %(maxdepth)i), %(dropped)i dropped, %(inline)i inline') % pool)
+   phenny.say(('output: %(control)i control and %(chat)i chat lines ' + 
+      'queued for %(targets)i targets, %(sent)i sent') % report['sender'])
+   cache = report['web']['cache']
+   lookups = cache['hits'] + cache['revalidated'] + cache['misses']
+   phenny.say(('web cache: %i hits, %i revalidated, %i misses (%.0f%% hit), ' + 
+      '%.0fKB saved; %i fetches coalesced') % (cache['hits'], cache['revalidated'], 
+      cache['misses'], 100.0 * (cache['hits'] + cache['revalidated']) / (lookups or 1), 
+      cache['saved'] / 1024.0, report['web']['coalesced']))
+perf.commands = ['perf']
+perf.priority = 'low'
+perf.example = '.perf or .perf gettitle'
+
 if __name__ == '__main__': 
    print __doc__.strip()
@@ -17,16 +17,30 @@ Pieces of information stored:
 NickTracker also has some configuration options. Example:
     nicktracker = {
         'expiry': 30*60,
+        'cache': 1024,
+        'interval': 1.0,
+        'window': 3,
+        'timeout': 30,
     }
 
+Where the server supports them, accounts are found in bulk: a WHOX query 
+(WHO #chan %tnuhfa) for every channel we join, plus the account-notify and 
+extended-join capabilities to keep up with changes. Asking NickServ about 
+each nick with ACC is only the fallback.
+
 Options:
  * expiry: How long (in seconds) we should keep data before updating it.
+ * cache: How many nicks to keep in memory, so that identifying the sender of 
+          a line doesn't need the database.
+ * interval: The least time (in seconds) between queries to NickServ.
+ * window: How many queries can be waiting for an answer at once.
+ * timeout: How long (in seconds) to wait for an answer before giving up.
 """
 #TODO: Add a daemon to update nicks, accounts, and registrations, even those offline.
 #TODO: Better handling of offline nicks in nick/account mapping
 from __future__ import absolute_import
-import time, bot, re, datetime, event, sqlite3, os
-from tools import DaemonThread
+import time, bot, re, datetime, event, db, os, threading, heapq
+from tools import LRUCache, Histogram
 
 storage = {} # This is used to store the data from INFO
 
@@ -39,6 +53,9 @@ ACCD_OFFLINE, ACCD_UNREGISTERED = 'offline', 'not registered'
 UNREGISTERED, OFFLINE, LOGGEDOUT, RECOGNIZED, LOGGEDIN = range(-2, 3)
 # Note: Status > 0 means they're sufficiently recognzied for us.
 
+# Tags our WHOX queries, so we know the replies are ours
+WHOX_TOKEN = '173'
+
 ACC_MAP = {
     (ACC_OFFLINE, ACCD_OFFLINE) : OFFLINE,
     (ACC_OFFLINE, ACCD_UNREGISTERED) : UNREGISTERED,
@@ -55,6 +72,16 @@ STATUS_TEXT = {
     LOGGEDIN: 'LOGGEDIN',
     }
 
+def accountstatus(account):
+    """
+    Turns the account name given by WHOX, extended-join, or account-notify 
+    into (account, status).
+    """
+    if account in ('*', '0'):
+        return None, LOGGEDOUT
+    else:
+        return bot.decode(account), LOGGEDIN
+
 def checkreserved(phenny, nick):
     """
     Just checks the nick against a set of nicks that we shouldn't query.
@@ -84,8 +111,8 @@ class CommandInput(bot.CommandInput):
             account, status = bot.nicktracker.getaccount(origin.nick)
             if account and status > 0:
                 self.canonnick = account
-                self.admin = self.canonnick.lower() in [a.lower() for a in bot.config.admins]
-                self.owner = self.canonnick.lower() == bot.config.owner.lower()
+                self.admin = self.canonnick.lower() in bot.nicktracker.admins
+                self.owner = self.canonnick.lower() == bot.nicktracker.owner
         return self
 
 CREATE_TABLE = """
@@ -105,6 +132,9 @@ class NickTracker(event.EventSource):
      * have-account: phenny, nick, account, status
        This is called whenever the account/status information is updated and we 
        have the account.
+     * nick-account: phenny, nick, account, status
+       This is called whenever we learn which account a nick belongs to, even 
+       if it isn't identified to it (eg, it's offline).
     """
     # This is used to store the nick<->accounts mapping
     db = None
@@ -113,22 +143,19 @@ class NickTracker(event.EventSource):
     def __init__(self, phenny):
         super(NickTracker, self).__init__()
         self.phenny = phenny
+        self.pool = phenny.pool
         self.expiry = DATA_EXPIRY_TIME
+        cachesize = 1024
         if hasattr(phenny.config, 'nicktracker'):
             self.expiry = phenny.config.nicktracker.get('expiry', self.expiry)
-        self.db = os.path.expanduser('~/.phenny/nicktracker.sqlite')
+            cachesize = phenny.config.nicktracker.get('cache', cachesize)
+        self.db = db.open('~/.phenny/nicktracker.sqlite')
+        self.db.executescript(CREATE_TABLE)
         
-        cursor = self._cursor()
-        cursor.executescript(CREATE_TABLE)
-    
-    def _conn(self):
-        # GRRRRRRR. sqlite3 doesn't allow multithreading. Want to strangle it.
-        conn = sqlite3.connect(self.db, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
-        conn.row_factory = sqlite3.Row
-        return conn
-    
-    def _cursor(self):
-        return self._conn().cursor()
+        # Rows from nickmap, by lowercased nick
+        self.cache = LRUCache(cachesize, self.expiry)
+        self.admins = set(a.lower() for a in phenny.config.admins)
+        self.owner = phenny.config.owner.lower()
     
     def getaccount(self, nick):
         """nt.getaccount(str) -> str|None, int|None
@@ -140,13 +167,14 @@ class NickTracker(event.EventSource):
             # If it's a reserved nick, just return it
             return nick, LOGGEDIN
         
-        cursor = self._cursor()
-        cursor.execute("SELECT * FROM nickmap WHERE nick=?", (nick,))
-        data = cursor.fetchone()
+        data = self.cache.get(nick.lower())
         if data is None:
-            # If we don't have that data, query for it so we can use it in the future.
-            query_acc(self.phenny, nick) # This needs to be done quickly, since we probably need that info.
-            return nick, None
+            data = self.db.execute("SELECT * FROM nickmap WHERE nick=?", (nick,)).fetchone()
+            if data is None:
+                # If we don't have that data, query for it so we can use it in the future.
+                query_acc(self.phenny, nick, priority='command') # This needs to be done quickly, since we probably need that info.
+                return nick, None
+            self.cache.set(nick.lower(), data)
         # Check to see if the data is out of date.
         if time.time() - data['updated'] > self.expiry:
             self._expire_data(nick)
@@ -178,6 +206,19 @@ class NickTracker(event.EventSource):
         else:
             return rv
     
+    def lastaccount(self, nick):
+        """nt.lastaccount(str) -> str|None
+        Returns the account the nick was last known to belong to, whether or not 
+        it's identified to it now. Doesn't ask NickServ.
+        """
+        data = self.cache.get(nick.lower())
+        if data is None:
+            data = self.db.execute("SELECT * FROM nickmap WHERE nick=?", (nick,)).fetchone()
+            if data is None:
+                return None
+            self.cache.set(nick.lower(), data)
+        return data['account']
+    
     def getalts(self, nick):
         """nt.getalts(str) -> [str], [str]
         Returns the other nicks to the given user. The first list is the nicks 
@@ -185,17 +226,14 @@ class NickTracker(event.EventSource):
         haven't seen, but are registered to them.
         """
         #TODO: Track maybes
-        with self._conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM nickmap WHERE nick=?", (nick,))
-            data = cursor.fetchone()
-            if data is None:
-                query_acc(self.phenny, nick) # This needs to be done quickly, since we probably need that info.
-                cursor.execute("SELECT DISTINCT nick FROM nickmap WHERE account=?", (nick,))
-            else:
-                if time.time() - data['updated'] > self.expiry:
-                    self._expire_data(nick)
-                cursor.execute("SELECT DISTINCT nick FROM nickmap WHERE account=? OR account=?", (nick, data['account']))
+        data = self.db.execute("SELECT * FROM nickmap WHERE nick=?", (nick,)).fetchone()
+        if data is None:
+            query_acc(self.phenny, nick, priority='command') # This needs to be done quickly, since we probably need that info.
+            cursor = self.db.execute("SELECT DISTINCT nick FROM nickmap WHERE account=?", (nick,))
+        else:
+            if time.time() - data['updated'] > self.expiry:
+                self._expire_data(nick)
+            cursor = self.db.execute("SELECT DISTINCT nick FROM nickmap WHERE account=? OR account=?", (nick, data['account']))
         
         return list(r['nick'] for r in cursor), []
     
@@ -204,8 +242,7 @@ class NickTracker(event.EventSource):
         Update information to reflect the nick change.
         """
         params = {'old': old, 'new': new}
-        with self._conn() as conn:
-            cursor = conn.cursor()
+        with self.db.transaction() as cursor:
             cursor.execute("INSERT OR REPLACE INTO nickmap (nick, account, status, updated) SELECT :new, account, status, updated FROM nickmap WHERE nick=:old", params) # Don't set updated, since we don't know anything new
             cursor.execute("UPDATE nickmap SET status=:status WHERE nick=:old", dict(status=OFFLINE, **params))
     
@@ -213,28 +250,43 @@ class NickTracker(event.EventSource):
         """
         Update nick/account mapping
         """
-        if nick is None:
+        self._updatemany([(account, nick, status)])
+    
+    def _updatemany(self, updates):
+        """
+        Update nick/account mappings from a list of (account, nick, status), 
+        all in one transaction.
+        """
+        if any(nick is None for account, nick, status in updates):
             raise ValueError
         
-        with self._conn() as conn:
-            cursor = conn.cursor()
-            data = {'nick': nick, 'account': account, 'status': status, 'updated': time.time()}
-            if status == OFFLINE:
-                cursor.execute("UPDATE nickmap SET status=:status, updated=:updated WHERE nick=:nick", data)
-            else:
-                cursor.execute("UPDATE nickmap SET account=:account, status=:status, updated=:updated WHERE nick=:nick", data)
-            if cursor.rowcount == 0:
-                cursor.execute("INSERT INTO nickmap (nick, account, status, updated) VALUES (:nick, :account, :status, :updated)", data)
+        now = time.time()
+        with self.db.transaction() as cursor:
+            for account, nick, status in updates:
+                data = {'nick': nick, 'account': account, 'status': status, 'updated': now}
+                if status == OFFLINE:
+                    cursor.execute("UPDATE nickmap SET status=:status, updated=:updated WHERE nick=:nick", data)
+                else:
+                    cursor.execute("UPDATE nickmap SET account=:account, status=:status, updated=:updated WHERE nick=:nick", data)
+                if cursor.rowcount == 0:
+                    cursor.execute("INSERT INTO nickmap (nick, account, status, updated) VALUES (:nick, :account, :status, :updated)", data)
+        
+        for account, nick, status in updates:
+            self.cache.invalidate(nick.lower())
+            
             # Is this still needed?
             if account is None and status > 0:
                 query_info(self.phenny, nick)
             
+            if account:
+                self.emit('nick-account', self.phenny, nick, account, status)
             if status > 0 and account:
                 self.emit('have-account', self.phenny, nick, account, status)
     
     def _removeaccount(self, account):
-        cursor = self._cursor()
-        cursor.execute("UPDATE nickmap SET account=NULL WHERE account=?", (account,))
+        self.db.execute("UPDATE nickmap SET account=NULL WHERE account=?", (account,))
+        # Any number of nicks could have pointed at it
+        self.cache.clear()
     
     def _updateinfo(self, data):
         """
@@ -248,68 +300,246 @@ class NickTracker(event.EventSource):
         Update the data from an TAXONOMY query.
         """
         global storage
-        d = storage[data.account.lower()]
-        d['Metadata'] = data.items
-        storage[data.account.lower()] = d
+        key = data.account.lower()
+        with storage.lock(key):
+            d = storage[key]
+            d['Metadata'] = data.items
+            storage[key] = d
     
     def _expire_data(self, nick):
         print "Expire: %r" % nick
-        nickprocessor.queue(nick)
+        nickprocessor.queue(nick, 'expire')
+    
+    def query(self, nick, priority='command'):
+        """nt.query(str, [str])
+        Asks NickServ about the nick's account and status. Priority is one of 
+        'command', 'join', 'expire', or 'names'.
+        """
+        query_acc(self.phenny, nick, priority=priority)
 
 def setup(phenny): 
     global nickprocessor
     phenny.nicktracker = NickTracker(phenny)
+    phenny.request_caps('account-notify', 'extended-join')
     phenny.extendclass('CommandInput', CommandInput)
-    nickprocessor = _DelayedNickProcessor(phenny)
-    nickprocessor.start()
+    options = getattr(phenny.config, 'nicktracker', {})
+    nickprocessor = _DelayedNickProcessor(phenny, 
+        interval=options.get('interval', 1.0), 
+        window=options.get('window', 3), 
+        timeout=options.get('timeout', 30))
+
+# The services query queue. Everything we ask NickServ goes through here, so that we don't flood it (especially when we connect), 
+# ask the same thing twice at once, or make somebody who just spoke wait behind a channel full of idlers.
+
+# Query priorities, most urgent first
+PRIORITIES = ('command', 'join', 'expire', 'names')
+
+QUERIES = {
+    'ACC': 'ACC %s *',
+    'ACCN': 'ACC %s', # Without the account, for when it doesn't say
+    'INFO': 'INFO =%s',
+    'INFOA': 'INFO %s', # By account
+    'TAXONOMY': 'TAXONOMY %s',
+    }
 
-# The nick process queue. So that we don't flood nickserv when we connect, we do initial loads gradually over time.
-class _DelayedNickProcessor(DaemonThread):
+class _DelayedNickProcessor(object):
     """
-    Class to manage the delayed processing queue.
+    Class to manage the services query queue. It has no thread of its own: 
+    queries go out as they're queued or answered, or from a phenny.timers job 
+    when the next one is due.
+    
+    Queries are (kind, nick) pairs, sent most urgent first. A query that's 
+    already queued or waiting for its answer isn't added again (although a 
+    more urgent request does move it up). Queries with no answer after 
+    timeout seconds are given up on.
+    
+    Only window queries are sent without having been answered, and they're 
+    spaced out by about twice NickServ's recent response time (but never less 
+    than interval seconds apart).
     """
-    nicks_to_process = None
     phenny = None
-    def __init__(self, phenny, **kw):
-        super(_DelayedNickProcessor, self).__init__(**kw)
-        self.daemon = True
+    def __init__(self, phenny, interval=1.0, window=3, timeout=30):
         self.phenny = phenny
-        self.nicks_to_process = set()
-    
-    def queue(self, nick):
-        """dnp.queue(str)
-        Queues the given nick for future processing.
+        self.interval = interval
+        self.window = window
+        self.timeout = timeout
+        
+        self.cond = threading.Condition()
+        self.heap = [] # (priority, seq, key)
+        self.queued = {} # key -> (priority, when queued)
+        self.delayed = 0 # Retries waiting on a timer
+        self.timer = None # The timer job that'll next send
+        self.inflight = {} # key -> when sent
+        self.seq = 0
+        self.nextsend = 0
+        self.rtt = None # Moving average of how long NickServ takes to answer
+        self.sent = self.answered = self.timeouts = self.collapsed = 0
+        self.wait = Histogram()
+    
+    def queue(self, nick, priority='names', kind='ACC'):
+        """dnp.queue(str, [str], [str]) -> bool
+        Queues the given query for future processing. Priority is one of 
+        PRIORITIES, and kind one of QUERIES.
         
-        If the given nick is already queued, nothing is done.
+        If the query is already queued or in flight, nothing is done (apart 
+        from raising its priority), and this returns False.
+        """
+        key = kind, nick.lower()
+        rank = PRIORITIES.index(priority)
+        with self.cond:
+            if key in self.inflight:
+                self.collapsed += 1
+                return False
+            if key in self.queued:
+                self.collapsed += 1
+                oldrank, queuedat = self.queued[key]
+                if rank >= oldrank:
+                    return False
+                # Move it up; the old heap entry gets skipped
+            else:
+                queuedat = time.time()
+            self.queued[key] = rank, queuedat
+            self.seq += 1
+            heapq.heappush(self.heap, (rank, self.seq, key))
+        self.pump()
+        return True
+    
+    def later(self, delay, nick, priority='names', kind='ACC'):
+        """dnp.later(number, str, [str], [str])
+        Queues the query in delay seconds.
+        """
+        with self.cond:
+            self.delayed += 1
+        self.phenny.timers.call_later(delay, self._retry, nick, priority, kind)
+    
+    def _retry(self, nick, priority, kind):
+        with self.cond:
+            self.delayed -= 1
+        self.queue(nick, priority, kind)
+    
+    def done(self, kinds, nick):
+        """dnp.done(str|tuple, str)
+        NickServ has answered, so it's no longer in flight.
         """
-        self.nicks_to_process.add(nick.lower())
+        if isinstance(kinds, basestring):
+            kinds = (kinds,)
+        now = time.time()
+        with self.cond:
+            for kind in kinds:
+                sent = self.inflight.pop((kind, nick.lower()), None)
+                if sent is not None:
+                    self.answered += 1
+                    if self.rtt is None:
+                        self.rtt = now - sent
+                    else:
+                        self.rtt = 0.8 * self.rtt + 0.2 * (now - sent)
+        self.pump()
     
     def _rename(self, old, new):
         """
         Updates the queue in the case of a rename.
         """
-        try:
-            self.nicks_to_process.remove(old.lower())
-        except KeyError:
-            pass
-        else:
-            self.nicks_to_process.add(new.lower())
+        with self.cond:
+            for kind in QUERIES:
+                try:
+                    rank, queuedat = self.queued.pop((kind, old.lower()))
+                except KeyError:
+                    continue
+                key = kind, new.lower()
+                if key not in self.queued and key not in self.inflight:
+                    self.queued[key] = rank, queuedat
+                    self.seq += 1
+                    heapq.heappush(self.heap, (rank, self.seq, key))
     
     def _processed(self, nick):
         """
         We got a status for this nick, remove from queue.
         """
-        self.nicks_to_process.discard(nick.lower())
+        with self.cond:
+            self.queued.pop(('ACC', nick.lower()), None)
+            self.queued.pop(('ACCN', nick.lower()), None)
     
-    def run(self):
-        while True:
-            try:
-                nick = self.nicks_to_process.pop()
-            except KeyError:
-                pass
-            else:
-                query_acc(self.phenny, nick)
-            time.sleep(3.5) # The guideline is one message every 2 seconds, and irc.py enforces 3.
+    def spacing(self):
+        if self.rtt is None:
+            return self.interval
+        return max(self.interval, min(2 * self.rtt, self.timeout))
+    
+    def _next(self, now):
+        """
+        Returns the next key to send, or how long to wait before looking again.
+        """
+        for key, sent in self.inflight.items():
+            if now - sent > self.timeout:
+                # It's not coming
+                del self.inflight[key]
+                self.timeouts += 1
+                if self.rtt is not None:
+                    self.rtt = min(2 * self.rtt, self.timeout)
+        
+        waits = [self.timeout]
+        if self.inflight:
+            waits.append(min(self.inflight.values()) + self.timeout - now)
+        
+        if len(self.inflight) < self.window and now >= self.nextsend:
+            while self.heap:
+                rank, seq, key = heapq.heappop(self.heap)
+                if self.queued.get(key, (None,))[0] != rank:
+                    continue # Stale
+                rank, queuedat = self.queued.pop(key)
+                self.wait.add(now - queuedat)
+                return key
+        elif self.heap and len(self.inflight) < self.window:
+            waits.append(self.nextsend - now)
+        return max(min(waits), 0.01)
+    
+    def pump(self):
+        """
+        Sends whatever can be sent now, and sets a timer for when there'll be 
+        more to do.
+        """
+        send = []
+        with self.cond:
+            while True:
+                now = time.time()
+                key = self._next(now)
+                if not isinstance(key, tuple):
+                    break
+                self.inflight[key] = now
+                self.nextsend = now + self.spacing()
+                self.sent += 1
+                send.append(key)
+            
+            wake = now + key
+            if self.timer is None or self.timer.cancelled or self.timer.when > wake:
+                if self.timer is not None:
+                    self.phenny.timers.cancel(self.timer)
+                self.timer = self.phenny.timers.call_at(wake, self._wake)
+        
+        for kind, nick in send:
+            self.phenny.msg('NickServ', QUERIES[kind] % nick)
+    
+    def _wake(self):
+        with self.cond:
+            self.timer = None
+        self.pump()
+    
+    def stats(self):
+        with self.cond:
+            queued = dict((p, 0) for p in PRIORITIES)
+            for rank, queuedat in self.queued.itervalues():
+                queued[PRIORITIES[rank]] += 1
+            return {
+                'queued': queued,
+                'delayed': self.delayed,
+                'inflight': len(self.inflight),
+                'sent': self.sent,
+                'answered': self.answered,
+                'timeouts': self.timeouts,
+                'collapsed': self.collapsed,
+                'rtt': self.rtt,
+                'spacing': self.spacing(),
+                'wait': self.wait.todict(),
+                }
 
 ############
 # TRIGGERS #
@@ -325,61 +555,118 @@ def trigger_nick(phenny, input):
     print "Nick: %s -> %s" % (old, new)
     # Update the database
     phenny.nicktracker._changenick(old, new)
+    phenny.nicktracker.cache.invalidate(old.lower())
+    phenny.nicktracker.cache.invalidate(new.lower())
     
     # Update the processing queue
     nickprocessor._rename(old, new)
-trigger_nick.rule = r'(.*)'
-trigger_nick.event = 'NICK'
+trigger_nick.observe = 'NICK'
 trigger_nick.priority = 'low'
 
 nick_host = {}
 
 def trigger_join(phenny, input):
     """
-    When someone joins our channel, query them
+    When someone joins our channel, query them. When we join, ask about 
+    everybody there in one go, if the server lets us.
     """
     global nick_host
     print "Join:", repr(input)
     nick_host[input.nick] = (input.origin.user, input.origin.host)
+    if input.nick.lower() == phenny.nick.lower():
+        if 'WHOX' in phenny.isupport:
+            channel = input.args[0] if input.args else input.origin.trailing
+            phenny.write(('WHO', channel, '%tnuhfa,' + WHOX_TOKEN))
+        return
     if checkreserved(phenny, input.nick): return
-    query_acc(phenny, input.nick, retry=True)
-trigger_join.rule = r'(.*)'
-trigger_join.event = 'JOIN'
+    if 'extended-join' in phenny.caps and len(input.args) > 1:
+        # The account came with the join
+        nickprocessor._processed(input.nick)
+        account, status = accountstatus(input.args[1])
+        phenny.nicktracker._updatelive(account, input.nick, status)
+        return
+    query_acc(phenny, input.nick, retry=True, priority='join')
+trigger_join.observe = 'JOIN'
 trigger_join.priority = 'low'
 
+whox_pending = []
+whox_lock = threading.Lock()
+
+def trigger_whox(phenny, input):
+    """
+    A reply to the WHOX query we send when joining. These are saved up until 
+    the end of the list, and then written all at once.
+    """
+    if len(input.args) < 7 or input.args[1] != WHOX_TOKEN: return
+    user, host, nick, flags, account = input.args[2:7]
+    nick_host[nick] = (user, host)
+    if checkreserved(phenny, nick): return
+    nickprocessor._processed(nick)
+    account, status = accountstatus(account)
+    with whox_lock:
+        whox_pending.append((account, bot.decode(nick), status))
+trigger_whox.observe = '354'
+trigger_whox.priority = 'low'
+trigger_whox.thread = False # So they're all in before the end of the list
+
+def trigger_endofwho(phenny, input):
+    """
+    The end of a WHO list, so write out what it told us.
+    """
+    with whox_lock:
+        updates = whox_pending[:]
+        del whox_pending[:]
+    if updates:
+        print "WHOX: %i nicks" % len(updates)
+        phenny.nicktracker._updatemany(updates)
+trigger_endofwho.observe = '315'
+trigger_endofwho.priority = 'low'
+
+def trigger_account(phenny, input):
+    """
+    Somebody logged in or out (account-notify)
+    """
+    if checkreserved(phenny, input.nick): return
+    nickprocessor._processed(input.nick)
+    account, status = accountstatus(input.args[0] if input.args else input.origin.trailing)
+    phenny.nicktracker._updatelive(account, input.nick, status)
+trigger_account.observe = 'ACCOUNT'
+trigger_account.priority = 'low'
+
 def trigger_list(phenny, input):
     """
     When we join a channel, schedule queries for existing members
     """
     print "List:", repr(input)
+    if 'WHOX' in phenny.isupport:
+        return # The WHO we sent when we joined covers them
     
     for nick in input.split(' '):
         if nick[0] in '@+':
             nick = nick[1:]
         if checkreserved(phenny, nick):
             continue
-        nickprocessor.queue(nick.lower())
-trigger_list.rule = r'(.*)'
-trigger_list.event = '353'
+        nickprocessor.queue(nick, 'names')
+trigger_list.observe = '353'
 trigger_list.priority = 'low'
 
 def trigger_part(phenny, input):
     """
     If somebody leaves, do a status update.
     """
-    nickprocessor.queue(input.nick.lower())
-trigger_part.rule = r'(.*)'
-trigger_part.event = 'PART'
+    phenny.nicktracker.cache.invalidate(input.nick.lower())
+    nickprocessor.queue(input.nick, 'expire')
+trigger_part.observe = 'PART'
 trigger_part.priority = 'low'
 
 def trigger_quit(phenny, input):
     """
     If somebody leaves, do a status update.
     """
-    nickprocessor.queue(input.nick.lower())
-trigger_part.rule = r'(.*)'
-trigger_part.event = 'QUIT'
-trigger_part.priority = 'low'
+    phenny.nicktracker.cache.invalidate(input.nick.lower())
+    nickprocessor.queue(input.nick, 'expire')
+trigger_quit.observe = 'QUIT'
+trigger_quit.priority = 'low'
 
 #TODO: Handle mode ("* ChanServ gives channel operator status to douglas")
 
@@ -393,17 +680,35 @@ def cmd_nickhost(phenny, input):
 cmd_nickhost.commands = ['nickhost']
 
 def cmd_acc(phenny, input):
-    query_acc(phenny, input.group(2) or input.nick)
+    query_acc(phenny, input.group(2) or input.nick, priority='command')
 cmd_acc.commands = ['acc']
 
 def cmd_info(phenny, input):
-    query_info(phenny, input.group(2) or input.nick)
+    query_info(phenny, input.group(2) or input.nick, priority='command')
 cmd_info.commands = ['ninfo']
 
 def cmd_taxonomy(phenny, input):
-    query_taxonomy(phenny, input.group(2) or input.nick)
+    query_taxonomy(phenny, input.group(2) or input.nick, priority='command')
 cmd_taxonomy.commands = ['taxo']
 
+def cmd_queue(phenny, input):
+    stats = nickprocessor.stats()
+    queued = ', '.join('%i %s' % (stats['queued'][p], p) for p in PRIORITIES)
+    rtt = 'unknown' if stats['rtt'] is None else '%.1fs' % stats['rtt']
+    wait = stats['wait']
+    phenny.reply(("Queued: %s; %i delayed, %i in flight. " + 
+        "Sent %i, answered %i, %i timed out, %i duplicates collapsed. " + 
+        "NickServ takes %s, sending every %.1fs. Wait p50 %s, p90 %s.") % (
+        queued, stats['delayed'], stats['inflight'], 
+        stats['sent'], stats['answered'], stats['timeouts'], stats['collapsed'], 
+        rtt, stats['spacing'], secs(wait['p50']), secs(wait['p90'])))
+cmd_queue.commands = ['nsq']
+
+def secs(s):
+    if s is None:
+        return '-'
+    return '%.1fs' % s
+
 def cmd_canon(phenny, input):
     print "Canon: %r" % input
     nick = input.group(2) or input.nick
@@ -423,6 +728,10 @@ def cmd_alts(phenny, input):
         phenny.reply("No alternate nicks found for %s." % nick)
 cmd_alts.commands = ['alts']
 
+def cmd_cache(phenny, input):
+    phenny.reply("%(size)i nicks cached, %(hits)i hits, %(misses)i misses, %(evictions)i evicted" % phenny.nicktracker.cache.stats())
+cmd_cache.commands = ['ntcache']
+
 ################
 # DATA HELPERS #
 ################
@@ -472,23 +781,16 @@ def parsedate(d):
 ################
 
 acc_retry = set()
-acc_queried_nicks = set()
 
-def query_acc(phenny, nick, retry=False, noacct=False):
+def query_acc(phenny, nick, retry=False, noacct=False, priority='command'):
     if nick == '*': return # Special nick that causes less-than-useful output
     # Don't query ourselves, NickServ, or servers
     if checkreserved(phenny, nick):
         return
     lnick = nick.lower()
-    if lnick in acc_queried_nicks: return
-    nickprocessor._processed(nick) # Remove this nick from the processing queue
-    acc_queried_nicks.add(lnick)
     if retry:
         acc_retry.add(lnick)
-    if noacct:
-        phenny.msg('Nickserv', 'ACC %s' % nick)
-    else:
-        phenny.msg('Nickserv', 'ACC %s *' % nick)
+    nickprocessor.queue(nick, priority, 'ACCN' if noacct else 'ACC')
 
 def nickserv_acc(phenny, input): 
     global acc_retry
@@ -498,25 +800,24 @@ def nickserv_acc(phenny, input):
     account = input.group(2)
     status = ACC_MAP[(int(input.group(3)), input.group(4))]
     
-    acc_queried_nicks.discard(lnick)
+    nickprocessor.done(('ACC', 'ACCN'), nick)
     if account == '*':
         if status == OFFLINE:
             account = None
         elif status == UNREGISTERED:
             # Possible that it's actually LOGGEDOUT
-            query_acc(phenny, nick, noacct=True) # We don't need to repass retry because we're not removing it.
+            query_acc(phenny, nick, noacct=True, priority='command') # We don't need to repass retry because we're not removing it.
             return
     
     print "ACC: %s (%s): %s" % (nick, account, STATUS_TEXT.get(status, status))
     
     phenny.nicktracker._updatelive(account, nick, status)
     if status > 0:
-        query_info(phenny, nick)
+        query_info(phenny, nick, priority='expire')
         acc_retry.discard(lnick)
     elif lnick in acc_retry:
         acc_retry.remove(lnick)
-        time.sleep(60) #Based on the length of NickServ's enforcement.
-        query_acc(phenny, nick)
+        nickprocessor.later(60, nick, 'join') #Based on the length of NickServ's enforcement.
 nickserv_acc.rule = r'([^ ]*)(?: -> ([^ ]*))? ACC ([0123])(?: \((.*)\))?'
 nickserv_acc.event = 'NOTICE'
 nickserv_acc.priority = 'low'
@@ -528,15 +829,12 @@ nickserv_acc.thread = True
 #################
 
 tmp_info = None
-info_queried_nicks = set()
 
-def query_info(phenny, nick):
+def query_info(phenny, nick, priority='expire'):
     # Don't query ourselves, NickServ, or servers
     if checkreserved(phenny, nick):
         return
-    if nick.lower() not in info_queried_nicks: # Prevent repeated queries
-        info_queried_nicks.add(nick.lower())
-        phenny.msg('Nickserv', 'INFO =%s' % nick)
+    nickprocessor.queue(nick, priority, 'INFO') # Repeated queries are collapsed
 
 def nickserv_info_begin(phenny, input): 
     global tmp_info
@@ -545,7 +843,7 @@ def nickserv_info_begin(phenny, input):
     if input.group(2):
         nick, account = input.groups()
     else:
-        nick = account = input.groups()
+        nick = account = input.group(1)
     tmp_info = DataHolder(account, nick)
 nickserv_info_begin.rule = r'Information on \x02(.*?)\x02(?: \(account \x02(.*?)\x02\))?:'
 nickserv_info_begin.event = 'NOTICE'
@@ -603,7 +901,7 @@ def nickserv_info_finish(phenny, input):
     
     print "INFO:", tmp_info
     
-    info_queried_nicks.discard(tmp_info.nick.lower())
+    nickprocessor.done(('INFO', 'INFOA'), tmp_info.nick)
     phenny.nicktracker._updateinfo(tmp_info)
     tmp_info = None
 nickserv_info_finish.rule = r'\*\*\* \x02End of Info\x02 \*\*\*'
@@ -616,11 +914,12 @@ def nickserv_info_notregistered(phenny, input):
     
     nick = input.group(1)
     print "INFO: Not Registered:", nick
-    lnick = nick.lower()
-    info_queried_nicks.discard(lnick)
     if nick[0] == '=':
-        phenny.msg('Nickserv', 'INFO %s' % nick[1:])
+        nickprocessor.done('INFO', nick[1:])
+        nickprocessor.queue(nick[1:], 'expire', 'INFOA')
         phenny.nicktracker._removeaccount(nick)
+    else:
+        nickprocessor.done('INFOA', nick)
 nickserv_info_notregistered.rule = r'\x02(.*)\x02 is not registered\.'
 nickserv_info_notregistered.event = 'NOTICE'
 nickserv_info_notregistered.priority = 'low'
@@ -631,7 +930,7 @@ def nickserv_info_marked(phenny, input):
     
     nick, setter, date, reason = input.groups()
     print "INFO: Marked: %s (%s): by %s on %s" % (nick, reason, setter, date)
-    info_queried_nicks.discard(nick.lower())
+    nickprocessor.done(('INFO', 'INFOA'), nick.lstrip('='))
     phenny.nicktracker._removeaccount(nick)
 nickserv_info_marked.rule = r"\x02(.+)\x02 is not registered anymore, but was marked by (.+) on (.+) \((.+)\)\."
 nickserv_info_marked.event = 'NOTICE'
@@ -647,10 +946,10 @@ nickserv_info_marked.thread = True
 
 tmp_taxo = None
 
-def query_taxonomy(phenny, nick):
+def query_taxonomy(phenny, nick, priority='expire'):
     if checkreserved(phenny, nick):
         return
-    phenny.msg('Nickserv', 'TAXONOMY %s' % nick)
+    nickprocessor.queue(nick, priority, 'TAXONOMY')
 
 def nickserv_taxonomy_begin(phenny, input): 
     global tmp_taxo
@@ -681,6 +980,7 @@ def nickserv_taxonomy_finish(phenny, input):
     print "TAXONOMY:", tmp_taxo
     
     assert tmp_taxo.account == input.group(1)
+    nickprocessor.done('TAXONOMY', tmp_taxo.account)
     
     phenny.nicktracker._updatetaxo(tmp_taxo)
     tmp_taxo = None
@@ -7,33 +7,26 @@ Licensed under the Eiffel Forum License 2.
 http://inamidst.com/phenny/
 """
 
-import os, re, time, threading
+import os, re, time
 
+# Reminders are kept by phenny.timers now; this is only here so that ones 
+# saved by older versions (time -> list of reminders) get moved over.
 storage = {}
 
 def setup(phenny): 
+  phenny.timers.register('remind', deliver)
 
-  def monitor(phenny): 
-    global storage
-    #NICKTRACKER: Use currently logged-in nicks as fallback targets.
-    time.sleep(5)
-    while True: 
-      now = int(time.time())
-      unixtimes = [int(key) for key in storage]
-      oldtimes = [t for t in unixtimes if t <= now]
-      if oldtimes: 
-        for oldtime in oldtimes: 
-          for (channel, nick, message) in storage[oldtime]: 
-            if message: 
-              phenny.msg(channel, nick + ': ' + message)
-            else: phenny.msg(channel, nick + '!')
-          del storage[oldtime]
-      time.sleep(2.5)
-
-  targs = (phenny,)
-  t = threading.Thread(target=monitor, args=targs)
-  t.daemon = True
-  t.start()
+  for key in list(storage): 
+    for reminder in storage[key]: 
+      phenny.timers.schedule(int(key), 'remind', reminder)
+    del storage[key]
+
+def deliver(phenny, reminder): 
+  #NICKTRACKER: Use currently logged-in nicks as fallback targets.
+  channel, nick, message = reminder
+  if message: 
+    phenny.msg(channel, nick + ': ' + message)
+  else: phenny.msg(channel, nick + '!')
 
 
 scaling = {
@@ -102,8 +95,7 @@ def remind(phenny, input):
     t = int(time.time()) + duration
     reminder = (input.sender, input.nick, message)
 
-    try: storage[t].append(reminder)
-    except KeyError: storage[t] = [reminder]
+    phenny.timers.schedule(t, 'remind', reminder)
 
     try:
         if duration >= 60: 
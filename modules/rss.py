@@ -12,7 +12,7 @@ Licensed under the MIT License: http://www.opensource.org/licenses/mit-license.p
 
 #later we can make this use SQlite if we want
 #import sqlite3
-import time, threading, feedparser, gdata.youtube, gdata.youtube.service
+import sys, time, traceback, feedparser, gdata.youtube, gdata.youtube.service
 
 def setup(phenny): 
 
@@ -39,7 +39,7 @@ def setup(phenny):
     oldTggYoutubeFeed = youtubeServe.GetYouTubeVideoFeed(youtubeTggUri)
     
     import time
-    time.sleep(20)
+    yield 20
     
     while True: 
       
@@ -177,12 +177,23 @@ def setup(phenny):
       
       #phenny.msg(testChannel, "sleeping...")
       import time
-      time.sleep(3600)
+      yield 3600
   
-  targs = (phenny,)
-  t = threading.Thread(target=monitor, args=targs)
-  t.daemon = True
-  t.start()
+  # Each step of monitor() runs as a phenny.timers job, and yields how long 
+  # to wait until the next. An error ends it, so it's started over (with 
+  # fresh feeds to compare against) a little later.
+  def run(phenny): 
+    while True: 
+      try: 
+        for delay in monitor(phenny): 
+          yield delay
+      except Exception: 
+        print >> sys.stderr, "Error checking the feeds:"
+        traceback.print_exc()
+      yield 600
+  
+  steps = run(phenny)
+  phenny.timers.call_later(0, steps.next)
 
 
 
@@ -10,11 +10,14 @@ http://inamidst.com/phenny/
 import re
 import web
 
-def search(query): 
-   """Search using AjaxSearch, and return its JSON."""
+def searchuri(query): 
    uri = 'http://ajax.googleapis.com/ajax/services/search/web'
    args = '?v=1.0&safe=off&q=' + web.urllib.quote(query.encode('utf-8'))
-   bytes = web.get(uri + args)
+   return uri + args
+
+def search(query): 
+   """Search using AjaxSearch, and return its JSON."""
+   bytes = web.get(searchuri(query), ttl=10*60)
    return web.json(bytes)
 
 def result(query): 
@@ -23,7 +26,9 @@ def result(query):
    except IndexError: return None
 
 def count(query): 
-   results = search(query)
+   return estimate(search(query))
+
+def estimate(results): 
    if not results.has_key('responseData'): return '0'
    if not results['responseData'].has_key('cursor'): return '0'
    if not results['responseData']['cursor'].has_key('estimatedResultCount'): 
@@ -155,13 +160,13 @@ def gcs(phenny, input):
    if len(queries) > 6: 
       return phenny.reply('Sorry, can only compare up to six things.')
 
+   # All at once; web.py spaces the requests out for Google
+   queries = [query.strip('[]') for query in queries]
+   pages = web.fetch_many([searchuri(query) for query in queries], ttl=10*60)
    results = []
-   for i, query in enumerate(queries): 
-      query = query.strip('[]')
-      n = int((formatnumber(count(query)) or '0').replace(',', ''))
+   for query, bytes in zip(queries, pages): 
+      n = int((formatnumber(estimate(web.json(bytes))) or '0').replace(',', ''))
       results.append((n, query))
-      if i >= 2: __import__('time').sleep(0.25)
-      if i >= 4: __import__('time').sleep(0.25)
 
    results = [(term, n) for (n, term) in reversed(sorted(results))]
    reply = ', '.join('%s (%s)' % (t, formatnumber(n)) for (t, n) in results)
@@ -7,7 +7,7 @@ Licensed under the Eiffel Forum License 2.
 http://inamidst.com/phenny/
 """
 
-import time
+import time, threading, atexit
 from tools import deprecated
 from decimal import *
 import os
@@ -17,6 +17,70 @@ storage = {} # Default value
 
 SEEN_LIMIT = 5
 
+# How often (in seconds) to write out sightings. Configurable as 
+# seen = {'flush': 60}
+FLUSH_INTERVAL = 60
+
+# Marks storage as converted from the old layout (see setup())
+FORMAT_KEY = 'meta:format'
+FORMAT = 2
+
+# Every sighting is kept here (storage key -> (nick, channel, time)) and 
+# written out to storage in batches
+table = {}
+dirty = set()
+table_lock = threading.Lock()
+# Held over a whole flush, so that an older batch can't land after a newer one
+flush_lock = threading.Lock()
+
+# The timer job doing the flushing. Kept over a reload (which runs this file 
+# again in the same module), so that setup() can cancel the old one.
+flusher = globals().get('flusher')
+
+def setup(phenny):
+    interval = getattr(phenny.config, 'seen', {}).get('flush', FLUSH_INTERVAL)
+    
+    with table_lock:
+        table.clear()
+        dirty.clear()
+        items = storage.items_in_range('account:', 'account;') + storage.items_in_range('nick:', 'nick;')
+        if storage.get(FORMAT_KEY) != FORMAT:
+            # Old style, keyed by bare nick. Looking for these takes a pass 
+            # over everything, so it's only done the once.
+            for key in list(storage):
+                if not key.startswith(('nick:', 'account:', 'meta:')):
+                    data = storage[key]
+                    del storage[key]
+                    items.append(('nick:' + key, data))
+                    dirty.add('nick:' + key)
+            storage[FORMAT_KEY] = FORMAT
+        for key, data in items:
+            if len(data) == 2:
+                # Old style, without the nick
+                data = [key.split(':', 1)[1]] + list(data)
+                dirty.add(key)
+            if key not in table or table[key][2] < data[2]:
+                table[key] = tuple(data)
+    
+    global flusher
+    if flusher is None:
+        atexit.register(flush, phenny)
+    else:
+        phenny.timers.cancel(flusher)
+    flusher = phenny.timers.every(interval, flush, phenny)
+
+def flush(phenny):
+    """
+    Writes the sightings that have changed since the last flush to storage.
+    """
+    with flush_lock:
+        with table_lock:
+            keys = list(dirty)
+            dirty.clear()
+            data = [(key, table[key]) for key in keys]
+        for key, value in data:
+            storage[key] = value
+
 #NICKTRACKER: If passed a known registered user, check agaisnt all names they've used and print the most recent ones.
 
 def f_seen(phenny, input): 
@@ -37,10 +101,7 @@ def f_seen(phenny, input):
         return phenny.say("I'm right here, actually.")
     
     lnick = nick.lower()
-    if lnick in storage:
-        storage['nick:'+lnick] = storage[lnick]
-        del storage[lnick]
-    nicks = set('nick:'+lnick)
+    nicks = set(['nick:'+lnick])
     
     if hasattr(phenny, 'nicktracker'):
         nicks.add('account:'+phenny.nicktracker.canonize(nick).lower())
@@ -48,14 +109,11 @@ def f_seen(phenny, input):
         nicks |= set('nick:'+n.lower() for n in alts+maybes)
     
     seennicks = {}
-    for nick in nicks:
-        try:
-            data = storage[nick]
-            if len(data) == 2:
-                data = storage[nick] = [nick, data[0], data[1]]
-            seennicks[data[0].lower()] = data
-        except KeyError:
-            pass
+    with table_lock:
+        for key in nicks:
+            data = table.get(key)
+            if data is not None:
+                seennicks[data[0].lower()] = data
     
     seennicks = sorted(seennicks.values(), key=lambda i: -i[2])
     
@@ -79,20 +137,21 @@ def f_seen(phenny, input):
             phenny.reply("(%i more)" % (len(seennicks) - SEEN_LIMIT))
     
     #no record of user
-    else: 
+    else:
         phenny.say("Sorry, I haven't seen %s around." % input.group(2))
 f_seen.rule = (['seen', 'lastseen'], r'(\S+)')
 
 def f_note(phenny, input): 
-    global storage
     if input.sender.startswith('#'):
-        lnick = input.nick.lower()
-        if lnick in storage:
-            del storage[lnick]
-        storage['nick:'+lnick] = (input.nick, input.sender, time.time())
+        sighting = (input.nick, input.sender, time.time())
+        keys = ['nick:'+input.nick.lower()]
         if hasattr(phenny, 'nicktracker') and input.canonnick:
-            storage['account:'+input.canonnick.lower()] = (input.nick, input.sender, time.time()) #XXX: Make this a list?
-f_note.rule = r'(.*)'
+            keys.append('account:'+input.canonnick.lower()) #XXX: Make this a list?
+        with table_lock:
+            for key in keys:
+                table[key] = sighting
+            dirty.update(keys)
+f_note.observe = 'PRIVMSG'
 f_note.priority = 'low'
 
 if __name__ == '__main__': 
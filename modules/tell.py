@@ -7,7 +7,7 @@ Licensed under the Eiffel Forum License 2.
 http://inamidst.com/phenny/
 """
 
-import os, re, time, random
+import os, re, time, random, threading
 import web
 from tools import startdaemon
 
@@ -26,7 +26,133 @@ lispchannels = frozenset([ '#lisp', '#scheme', '#opendarwin', '#macdev',
 
 storage = {}
 
+# An index of the exact storage keys, so that checking somebody with no 
+# messages waiting is cheap. Keys ending in * are found with the store's own 
+# wildcard_matches().
+pending = set()
+index_lock = threading.Lock()
+
+# Exact keys are also filed under the account their nick belongs to (when 
+# nicktracker knows it), so that a tell left for one nick is found when its 
+# owner speaks from another.
+accounts = {} # account -> set of keys
+owners = {} # key -> account
+watching = False
+
+def iswildcard(key):
+    return key.endswith('*') and not key.endswith(':')
+
+def wildcardkey(key):
+    """
+    Returns the one form of a wildcard key (stem*) that wildcard_matches() 
+    looks for.
+    """
+    return key.rstrip('*:') + '*'
+
+def index_add(key):
+    if iswildcard(key):
+        return
+    with index_lock:
+        pending.add(key)
+
+def index_claim(keys):
+    """
+    Takes the keys out of the index, returning the ones that were there. Only 
+    whoever claims a key delivers its messages. (Wildcard keys aren't in the 
+    index, so they're passed through.)
+    """
+    claimed = []
+    with index_lock:
+        for key in keys:
+            if iswildcard(key):
+                claimed.append(key)
+            elif key in pending:
+                pending.remove(key)
+                unfile(key)
+                claimed.append(key)
+    return claimed
+
+def index_drop(key):
+    """
+    Takes an exact key out of the index, if it's there.
+    """
+    with index_lock:
+        pending.discard(key)
+        unfile(key)
+
+def unfile(key):
+    """
+    Takes key out of the account index. Call with index_lock held.
+    """
+    account = owners.pop(key, None)
+    if account is not None:
+        keys = accounts[account]
+        keys.discard(key)
+        if not keys:
+            del accounts[account]
+
+def index_account(key, account):
+    """
+    Files a waiting key under the account its nick belongs to.
+    """
+    key, account = key.lower(), account.lower()
+    with index_lock:
+        if key not in pending or owners.get(key) == account:
+            return
+        unfile(key)
+        owners[key] = account
+        accounts.setdefault(account, set()).add(key)
+
+def nick_account(nt, phenny, nick, account, status):
+    index_account(nick, account)
+
+def watch(phenny):
+    """
+    Files the waiting keys by account, and listens for nicktracker learning 
+    more. This is done on first use, since nicktracker may not be set up by 
+    the time we are.
+    """
+    global watching
+    if watching or not hasattr(phenny, 'nicktracker'):
+        return
+    watching = True
+    phenny.nicktracker.connect('nick-account', nick_account, thread=False)
+    with index_lock:
+        keys = list(pending)
+    for key in keys:
+        account = phenny.nicktracker.lastaccount(key)
+        if account:
+            index_account(key, account)
+
+def maybe_waiting(ltellees):
+    """
+    Are there possibly messages for any of these (lowercase) nicks?
+    """
+    with index_lock:
+        for lt in ltellees:
+            if lt in pending or lt in accounts:
+                return True
+    for lt in ltellees:
+        if storage.wildcard_matches(lt):
+            return True
+    return False
+
 def setup(phenny):
+    global watching
+    with index_lock:
+        pending.clear()
+        accounts.clear()
+        owners.clear()
+        watching = False
+    for key in storage.keys():
+        if iswildcard(key) and key != wildcardkey(key):
+            # Left as bob:* or bob** by older versions
+            with storage.lock(key):
+                messages = storage.pop(key, [])
+            storage.modify(wildcardkey(key), lambda m: m + messages, [])
+        index_add(key)
+    watch(phenny)
+    
     if hasattr(phenny, 'nicktracker'):
         pass
 #        phenny.nicktracker.connect('have-account', do_have_account) # Can't get the correct context yet.
@@ -49,6 +175,8 @@ def f_remind(phenny, input):
     
     tellee_original = tellee.rstrip('.,:;')
     tellee = tellee_original.lower()
+    if iswildcard(tellee):
+        tellee = wildcardkey(tellee)
     
     if tellee == phenny.nick.lower():
        phenny.say("Sorry, I'm supposed to ignore any voices I hear in my head.")
@@ -61,12 +189,21 @@ def f_remind(phenny, input):
     if not tellee in (teller.lower(), phenny.nick, 'me'): # @@
         # @@ <deltab> and year, if necessary
         warn = False
-        if tellee not in storage: 
-            storage[tellee] = [(teller, verb, timenow, msg)]
-        else: 
-            # if len(storage[tellee]) >= maximum: 
+        def append(messages):
+            # if len(messages) >= maximum: 
             #    warn = True
-            storage[tellee].append((teller, verb, timenow, msg))
+            messages.append((teller, verb, timenow, msg))
+            return messages
+        # Under the key's lock, so that a delivery of the key either takes 
+        # this message with the rest, or comes after it's indexed again
+        with storage.lock(tellee):
+            storage.modify(tellee, append, [])
+            index_add(tellee)
+        watch(phenny)
+        if hasattr(phenny, 'nicktracker'):
+            account = phenny.nicktracker.lastaccount(tellee)
+            if account:
+                index_account(tellee, account)
         # @@ Stephanie's augmentation
         response = "I'll pass that on when %s is around." % tellee_original
         # if warn: response += (" I'll have to use a pastebin, though, so " + 
@@ -90,15 +227,21 @@ def getReminders(phenny, key, tellee):
     template = "At %s, %s asked me to %s %s %s"
     today = time.strftime('%d %b', time.gmtime())
     
-    for (teller, verb, datetime, msg) in storage[key]: 
+    try: 
+        with storage.lock(key):
+            messages = storage[key]
+            del storage[key]
+            # Told again since it was claimed? That's in messages too.
+            index_drop(key)
+    except KeyError: 
+        if not iswildcard(key): # Those can be found twice at once
+            phenny.say('Er...')
+        return []
+    
+    for (teller, verb, datetime, msg) in messages: 
         if datetime.startswith(today): 
             datetime = datetime[len(today)+1:]
         lines.append(template % (datetime, teller, verb, tellee, msg))
-    
-    try: 
-        del storage[key]
-    except KeyError: 
-        phenny.say('Er...')
     return lines
 
 def do_messages(phenny, nicks):
@@ -109,17 +252,21 @@ def do_messages(phenny, nicks):
             tellees += [phenny.nicktracker.canonize(nick)] + alts + maybes
     ltellees = [t.lower() for t in tellees]
     
+    # Which keys are for us, and who to address each one to
+    found = {}
+    with index_lock:
+        for lt in ltellees:
+            if lt in pending:
+                found.setdefault(lt, lt)
+            for remkey in accounts.get(lt, ()):
+                found.setdefault(remkey, remkey)
+    for lt in ltellees:
+        for remkey in storage.wildcard_matches(lt):
+            found.setdefault(remkey, lt)
+    
     reminders = []
-    remkeys = list(reversed(sorted(storage.keys())))
-    for remkey in remkeys: 
-        if not remkey.endswith('*') or remkey.endswith(':'): 
-            if remkey in ltellees:
-                reminders.extend(getReminders(phenny, remkey, remkey))
-        else:
-            srk = remkey.rstrip('*:')
-            for lt in ltellees:
-                if lt.startswith(srk):
-                    reminders.extend(getReminders(phenny, remkey, lt))
+    for remkey in reversed(sorted(index_claim(found))): 
+        reminders.extend(getReminders(phenny, remkey, found[remkey]))
     
     for line in reminders[:maximum]: 
         phenny.say(line)
@@ -127,12 +274,19 @@ def do_messages(phenny, nicks):
     if reminders[maximum:]: 
         phenny.say('Further messages sent privately')
         for line in reminders[maximum:]: 
-            phenny.msg(tellee, line)
+            phenny.msg(nicks[0], line)
 
 def message(phenny, input): 
     if not input.sender.startswith('#'): return
+    watch(phenny)
+    # Only look further (alt nicks and all) if there might be something
+    nicks = [input.nick.lower()]
+    canonnick = getattr(input, 'canonnick', None)
+    if canonnick:
+        nicks.append(canonnick.lower())
+    if not maybe_waiting(nicks): return
     do_messages(phenny, [input.nick])
-message.rule = r'(.*)'
+message.observe = 'PRIVMSG'
 message.priority = 'low'
 
 #NICKTRACKER: Listen to the have-account event and check tells then.
@@ -5,8 +5,9 @@ author: mutantmonkey <mutantmonkey@gmail.com>
 """
 
 from urllib import quote as urlquote
-from urllib2 import urlopen, HTTPError
+from StringIO import StringIO
 import lxml.html
+import web
 
 def tfw(phenny, input, fahrenheit=False, celsius=False):
 	""".tfw <city/zip> - Show the fucking weather at the specified location."""
@@ -24,12 +25,15 @@ def tfw(phenny, input, fahrenheit=False, celsius=False):
 		celsius_param = "&CELSIUS=yes"
 
 	try:
-		req = urlopen("http://thefuckingweather.com/?zipcode=%s%s" % (urlquote(zipcode), celsius_param))
-	except HTTPError:
+		with web.request("http://thefuckingweather.com/?zipcode=%s%s" % (urlquote(zipcode), celsius_param)) as req:
+			if req.status >= 400:
+				raise IOError(req.status)
+			bytes = req.read()
+	except IOError:
 		phenny.say("THE INTERNET IS FUCKING BROKEN. Please try again later.")
 		return
 
-	doc = lxml.html.parse(req)
+	doc = lxml.html.parse(StringIO(bytes))
 
 	location = doc.getroot().find_class('small')[0].text_content()
 
@@ -10,9 +10,12 @@ http://inamidst.com/phenny/
 
 ''' Keep sqlite local to this module for now '''
 
-import sqlite3
+import db
 import random, socket
 
+# tgg.db comes as it is, so leave its journal mode alone
+tggdb = db.open("tgg.db", wal=False)
+
 def fortune(phenny, input): 
   import subprocess
   import string
@@ -98,8 +101,7 @@ bugReport.example = ['.tggbug']
 bugReport.priority = 'medium'
 
 def insult_user(phenny, input):
-  db_conn = sqlite3.connect("tgg.db")
-  db_curr = db_conn.cursor()
+  db_curr = tggdb.cursor()
   nick = str(input.nick)
   t = (nick,)
   
@@ -124,8 +126,7 @@ def give_cookie(phenny, input):
   else:
     recepient = str(input.nick)
   #otherwise give specified user a cookie
-  db_conn = sqlite3.connect("tgg.db")
-  db_curr = db_conn.cursor()
+  db_curr = tggdb.cursor()
   #nick = str(input.nick)
   
   db_curr.execute( "SELECT * FROM cookie_flavors;" )
@@ -155,8 +156,7 @@ def give_food(phenny, input):
   else:
     recepient = str(input.nick)
   #otherwise give specified user a cookie
-  db_conn = sqlite3.connect("tgg.db")
-  db_curr = db_conn.cursor()
+  db_curr = tggdb.cursor()
   #nick = str(input.nick)
   
   db_curr.execute( "SELECT * FROM cookie_flavors;" )
@@ -187,8 +187,7 @@ def give_skittles(phenny, input):
   else:
     recepient = str(input.nick)
   #otherwise give specified user a cookie
-  db_conn = sqlite3.connect("tgg.db")
-  db_curr = db_conn.cursor()
+  db_curr = tggdb.cursor()
   #nick = str(input.nick)
   
   db_curr.execute( "SELECT * FROM skittles_colors;" )
@@ -218,8 +217,7 @@ def give_element(phenny, input):
     #if there's nothing after the command, give it to the person who triggered the command
     recepient = str(input.nick)
   #otherwise give specified user an element
-  db_conn = sqlite3.connect("tgg.db")
-  db_curr = db_conn.cursor()
+  db_curr = tggdb.cursor()
   #nick = str(input.nick)
    
   db_curr.execute( "SELECT * FROM element_type;" )
@@ -249,8 +247,7 @@ def give_sandwich(phenny, input):
   else:
     recepient = str(input.nick)
   #otherwise give specified user sandwich
-  db_conn = sqlite3.connect("tgg.db")
-  db_curr = db_conn.cursor()
+  db_curr = tggdb.cursor()
   #nick = str(input.nick)
   
   db_curr.execute( "SELECT * FROM sandwich_type;" )
@@ -275,8 +272,7 @@ def give_shake(phenny, input):
   else:
     recepient = str(input.nick)
   #otherwise give specified user shake
-  db_conn = sqlite3.connect("tgg.db")
-  db_curr = db_conn.cursor()
+  db_curr = tggdb.cursor()
   #nick = str(input.nick)
   
   db_curr.execute( "SELECT * FROM shake_flavor;" )
@@ -301,8 +297,7 @@ def give_pie(phenny, input):
   else:
     recepient = str(input.nick)
   #otherwise give specified user pie
-  db_conn = sqlite3.connect("tgg.db")
-  db_curr = db_conn.cursor()
+  db_curr = tggdb.cursor()
   #nick = str(input.nick)
   
   db_curr.execute( "SELECT * FROM pie_flavor;" )
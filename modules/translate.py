@@ -68,14 +68,13 @@ def mangle(phenny, input):
       if not phrase: 
          phrase = backup
          break
-      __import__('time').sleep(0.5)
 
+      # No sleeping in between: web.py keeps to Google's request rate
       backup = phrase
       phrase = translate(phrase, lang, 'en')
       if not phrase: 
          phrase = backup
          break
-      __import__('time').sleep(0.5)
 
    phenny.reply(phrase or 'ERRORS SRY')
 mangle.commands = ['mangle']
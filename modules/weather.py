@@ -16,11 +16,7 @@ r_from = re.compile(r'(?i)([+-]\d+):00 from')
 def location(name): 
   name = urllib.quote(name.encode('utf-8'))
   uri = 'http://ws.geonames.org/searchJSON?q=%s&maxRows=1' % name
-  for i in xrange(10): 
-    u = urllib.urlopen(uri)
-    if u is not None: break
-  bytes = u.read()
-  u.close()
+  bytes = web.get(uri, ttl=24*60*60)
 
   results = web.json(bytes)
   try: name = results['geonames'][0]['name']
@@ -39,7 +35,7 @@ class GrumbleError(object):
 def local(icao, hour, minute): 
    uri = ('http://www.flightstats.com/' + 
           'go/Airport/airportDetails.do?airportCode=%s')
-   try: bytes = web.get(uri % icao)
+   try: bytes = web.get(uri % icao, ttl=24*60*60)
    except AttributeError: 
       raise GrumbleError('A WEBSITE HAS GONE DOWN WTF STUPID WEB')
    m = r_from.search(bytes)
@@ -164,7 +160,8 @@ def f_weather(self, origin, match, args):
       return
 
    uri = 'http://weather.noaa.gov/pub/data/observations/metar/stations/%s.TXT'
-   try: bytes = web.get(uri % icao_code)
+   # METARs are issued every half hour or hour, so a few minutes is fine
+   try: bytes = web.get(uri % icao_code, ttl=5*60)
    except AttributeError: 
       raise GrumbleError('OH CRAP NOAA HAS GONE DOWN THE WEB IS BROKEN')
    if 'Not Found' in bytes: 
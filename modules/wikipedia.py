@@ -67,8 +67,8 @@ def wikipedia(term, last=False):
       else: t = term
       q = urllib.quote(t)
       u = wikiuri % q
-      bytes = web.get(u)
-   else: bytes = web.get(wikiuri % term)
+      bytes = web.get(u, ttl=60*60)
+   else: bytes = web.get(wikiuri % term, ttl=60*60)
    bytes = r_tr.sub('', bytes)
 
    if not last: 
@@ -23,7 +23,7 @@ def text(html):
    return text
 
 def wiktionary(word): 
-   bytes = web.get(uri % web.urllib.quote(word.encode('utf-8')))
+   bytes = web.get(uri % web.urllib.quote(word.encode('utf-8')), ttl=24*60*60)
    bytes = r_ul.sub('', bytes)
 
    mode = None
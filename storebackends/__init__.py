@@ -0,0 +1,139 @@
+"""
+Storage backends. Each module here provides a DataStore class; see STORAGE.md.
+The mixins here give every backend the same extras beyond MutableMapping.
+"""
+import bisect, threading, copy
+
+# How many locks KeyLocks spreads the keys over
+STRIPES = 64
+_stripelock = threading.Lock()
+
+def ukey(key):
+    """ukey(string) -> unicode
+    Returns key as unicode, decoding a byte string as UTF-8. Keys go through 
+    this before they're stored or compared, so that the same key is the same 
+    key however it was passed in.
+    """
+    if isinstance(key, str):
+        return key.decode('utf-8')
+    return unicode(key)
+
+class KeyLocks(object):
+    """
+    Mixin for DataStores, giving per-key locking and an atomic read-modify-
+    write. Keys share a fixed set of locks by hash, so there's no lock per key
+    to keep track of, and unrelated keys rarely wait on each other.
+
+    (These aren't called update() and the like, because MutableMapping already
+    has an update().)
+    """
+    _stripes = None
+
+    def lock(self, key):
+        """s.lock(string) -> RLock
+        Returns the lock for key. Hold it over a read and write of the key that
+        mustn't be interleaved with anyone else's.
+        """
+        if self._stripes is None:
+            with _stripelock:
+                if self._stripes is None:
+                    self._stripes = [threading.RLock() for _ in xrange(STRIPES)]
+        return self._stripes[hash(ukey(key)) % STRIPES]
+
+    def modify(self, key, func, default=None):
+        """s.modify(string, callable, [object]) -> object
+        Atomically sets key to func(value), where value is its current value,
+        or a copy of default if it's not there. Returns the new value.
+        """
+        with self.lock(key):
+            try:
+                value = self[key]
+            except KeyError:
+                value = copy.deepcopy(default)
+            value = func(value)
+            self[key] = value
+            return value
+
+class SortedKeys(object):
+    """
+    Mixin for DataStores, giving ordered queries on the keys from a sorted
+    index of them. The store calls _initkeys() with its keys, then _addkey()
+    and _dropkey() as they change (or overrides _sortedkeys(), if it has to
+    work the index out lazily).
+    """
+    _sorted = None
+
+    def _initkeys(self, keys):
+        self._keylock = threading.RLock()
+        self._sorted = sorted(set(ukey(key) for key in keys))
+
+    def _addkey(self, key):
+        key = ukey(key)
+        with self._keylock:
+            keys = self._sortedkeys()
+            i = bisect.bisect_left(keys, key)
+            if i == len(keys) or keys[i] != key:
+                keys.insert(i, key)
+
+    def _dropkey(self, key):
+        key = ukey(key)
+        with self._keylock:
+            keys = self._sortedkeys()
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+    def _sortedkeys(self):
+        """
+        Returns the sorted list of keys. Call with _keylock held.
+        """
+        return self._sorted
+
+    def keys_with_prefix(self, prefix):
+        """s.keys_with_prefix(string) -> [string]
+        Returns the keys that start with prefix, in order.
+        """
+        prefix = ukey(prefix)
+        with self._keylock:
+            keys = self._sortedkeys()
+            i = bisect.bisect_left(keys, prefix)
+            j = i
+            while j < len(keys) and keys[j].startswith(prefix):
+                j += 1
+            return keys[i:j]
+
+    def items_in_range(self, start=None, stop=None):
+        """s.items_in_range([string], [string]) -> [(string, object)]
+        Returns the items with start <= key < stop, in key order. Either end
+        may be left open.
+        """
+        start = None if start is None else ukey(start)
+        stop = None if stop is None else ukey(stop)
+        with self._keylock:
+            keys = self._sortedkeys()
+            i = 0 if start is None else bisect.bisect_left(keys, start)
+            j = len(keys) if stop is None else bisect.bisect_left(keys, stop)
+            keys = keys[i:j]
+        items = []
+        for key in keys:
+            try:
+                items.append((key, self[key]))
+            except KeyError: # Deleted in the meantime
+                pass
+        return items
+
+    def wildcard_matches(self, s, wildcard='*'):
+        """s.wildcard_matches(string, [string]) -> [string]
+        Returns the stored keys that end in wildcard and match s, ie s starts
+        with whatever comes before the wildcard. Shortest first.
+        """
+        s, wildcard = ukey(s), ukey(wildcard)
+        found = []
+        with self._keylock:
+            keys = self._sortedkeys()
+            for n in xrange(len(s) + 1):
+                key = s[:n] + wildcard
+                i = bisect.bisect_left(keys, key)
+                if i < len(keys) and keys[i] == key:
+                    found.append(key)
+        return found
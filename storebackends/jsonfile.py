@@ -8,28 +8,57 @@ The JSON File store keeps each key in it's own file, with the data JSON encoded.
 - Slow (every call makes at least one file system operation, plus JSON overhead)
 - Lots of files
 * Administratable using normal Unix tools (human readable text)
+
+The slowness can be traded for a little of the crash safety by turning on the 
+cache in the config:
+
+    jsonfile = {
+        'cache': 256, # How many values to keep in memory, per module
+        'flush': 5, # How often to write changes out, in seconds
+    }
+
+Reads are then served from memory (after checking the file hasn't been edited 
+since), and writes are saved up and written out in the background, each to a 
+temporary file that's renamed into place.
 """
 import collections
-import os, json, urllib
+import os, json, urllib, threading, time, atexit
+from sys import stderr
+from tools import DaemonThread
+from storebackends import SortedKeys, KeyLocks, ukey
+
+# Appended to the file name while writing. Never appears in a kenc()'d key.
+TEMP = '~'
 
 def kenc(key):
     """kenc(string) -> str
     Performs any encoding necessary for making a key filesystem safe
     """
-    return urllib.quote(unicode(key), safe=',:=+#').encode('utf-8')
+    return urllib.quote(ukey(key).encode('utf-8'), safe=',:=+#')
 
 def kdec(fn):
     """kdec(str) -> string
     Reverses kenc()
     """
-    return urllib.unquote(fn.decode('utf-8'))
+    return urllib.unquote(fn).decode('utf-8')
 
-class DataStore(collections.MutableMapping):
+class DataStore(SortedKeys, KeyLocks, collections.MutableMapping):
     """
     A store based on files of JSON data.
+    
+    The sorted index of keys for the ordered queries is built from a listing 
+    of the directory the first time it's needed, and kept up to date by our 
+    own writes after that. (Files added or removed by hand show up in lookups 
+    straight away, but not in the ordered queries until a restart.)
     """
+    def __new__(cls, phenny, module, default):
+        if cls is DataStore and getattr(phenny.config, 'jsonfile', {}).get('cache'):
+            cls = CachedDataStore
+        return super(DataStore, cls).__new__(cls)
+    
     def __init__(self, phenny, module, default):
         self._basename = os.path.join(os.path.expanduser('~/.phenny'), module.__name__)
+        self._keylock = threading.RLock()
         
         if not os.path.isdir(self._basename):
             os.mkdir(self._basename)
@@ -51,21 +80,235 @@ class DataStore(collections.MutableMapping):
         with open(self._getfile(key), 'w') as f:
             json.dump(value, f, indent=4)
             f.flush()
+        with self._keylock:
+            if self._sorted is not None:
+                self._addkey(key)
     
     def __delitem__(self, key):
         try:
             os.remove(self._getfile(key))
         except OSError: #File does not exist
             raise KeyError
+        with self._keylock:
+            if self._sorted is not None:
+                self._dropkey(key)
     
     def __len__(self):
-        return len(os.listdir(self._basename))
+        return sum(1 for fn in os.listdir(self._basename) if not fn.endswith(TEMP))
     
     def __iter__(self):
         for fn in os.listdir(self._basename):
+            if fn.endswith(TEMP):
+                continue
             key = kdec(fn)
             yield key
     
     def __contains__(self, key):
         return os.path.exists(self._getfile(key))
+    
+    def _listkeys(self):
+        return DataStore.__iter__(self)
+    
+    def _sortedkeys(self):
+        if self._sorted is None:
+            self._sorted = sorted(self._listkeys())
+        return self._sorted
+
+
+_DELETED = object() # Marks a pending delete in CachedDataStore._dirty
+_MISSING = object()
+
+class CachedDataStore(DataStore):
+    """
+    The JSON file store with a read cache and write-behind in front of it. 
+    DataStore gives you one of these if the cache is turned on.
+    
+    Every read still stats the file, so that hand edits are noticed, and the 
+    directory is only listed again when its mtime says something was added or 
+    removed by somebody else (a flush notes the mtime its own writes left).
+    
+    Flushing takes the changes out of _dirty and into _flushing, and writes 
+    them out without holding the lock. Reads look in both, so they never see 
+    the disk behind them.
+    """
+    def __init__(self, phenny, module, default):
+        options = phenny.config.jsonfile
+        self._size = options.get('cache', 256)
+        self._lock = threading.RLock()
+        self._cache = collections.OrderedDict() # key -> ((mtime, size), value)
+        self._dirty = {} # key -> value or _DELETED
+        self._flushing = {} # The same, for changes being written right now
+        self._flushlock = threading.Lock()
+        self._dirmtime = None
+        super(CachedDataStore, self).__init__(phenny, module, default)
+        self._keylock = self._lock
+        _register(self, options.get('flush', 5))
+    
+    def _stamp(self, fn):
+        st = os.stat(fn)
+        return st.st_mtime, st.st_size
+    
+    def _remember(self, key, stamp, value):
+        self._cache.pop(key, None)
+        self._cache[key] = stamp, value
+        while len(self._cache) > self._size:
+            self._cache.popitem(last=False)
+    
+    def _pending(self, key):
+        """
+        Returns the unwritten value for key, _DELETED, or _MISSING if there 
+        isn't one. Call with the lock held.
+        """
+        if key in self._dirty:
+            return self._dirty[key]
+        return self._flushing.get(key, _MISSING)
+    
+    def __getitem__(self, key):
+        key = ukey(key)
+        with self._lock:
+            value = self._pending(key)
+            if value is _DELETED:
+                raise KeyError(key)
+            elif value is not _MISSING:
+                return value
+            
+            fn = self._getfile(key)
+            try:
+                stamp = self._stamp(fn)
+            except OSError: # File does not exist
+                self._cache.pop(key, None)
+                raise KeyError(key)
+            try:
+                cached, value = self._cache.pop(key)
+            except KeyError:
+                pass
+            else:
+                if cached == stamp:
+                    self._cache[key] = cached, value
+                    return value
+            
+            value = super(CachedDataStore, self).__getitem__(key)
+            self._remember(key, stamp, value)
+            return value
+    
+    def __setitem__(self, key, value):
+        key = ukey(key)
+        with self._lock:
+            self._dirty[key] = value
+            self._cache.pop(key, None)
+            if self._sorted is not None:
+                self._addkey(key)
+    
+    def __delitem__(self, key):
+        key = ukey(key)
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            self._dirty[key] = _DELETED
+            self._cache.pop(key, None)
+            if self._sorted is not None:
+                self._dropkey(key)
+    
+    def __contains__(self, key):
+        key = ukey(key)
+        with self._lock:
+            value = self._pending(key)
+            if value is not _MISSING:
+                return value is not _DELETED
+            return os.path.exists(self._getfile(key))
+    
+    def _listkeys(self):
+        # What's on disk, plus what's waiting to be
+        keys = set(super(CachedDataStore, self)._listkeys())
+        for key, value in self._flushing.items() + self._dirty.items():
+            if value is _DELETED:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return keys
+    
+    def _sortedkeys(self):
+        mtime = os.stat(self._basename).st_mtime
+        if self._sorted is None or mtime != self._dirmtime:
+            self._sorted = sorted(self._listkeys())
+            self._dirmtime = mtime
+        return self._sorted
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._sortedkeys())
+    
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._sortedkeys())
+        return iter(keys)
+    
+    def flush(self):
+        """
+        Writes out everything that's changed.
+        """
+        with self._flushlock:
+            with self._lock:
+                flushing = self._flushing = self._dirty
+                self._dirty = {}
+                # Whether the index is up to date with the directory, so that 
+                # our own writes needn't make _sortedkeys() list it again
+                fresh = (self._sorted is not None and 
+                    os.stat(self._basename).st_mtime == self._dirmtime)
+            for key, value in flushing.iteritems():
+                fn = self._getfile(key)
+                try:
+                    if value is _DELETED:
+                        try:
+                            os.remove(fn)
+                        except OSError: # Already gone
+                            pass
+                        continue
+                    with open(fn + TEMP, 'w') as f:
+                        json.dump(value, f, indent=4)
+                        f.flush()
+                    os.rename(fn + TEMP, fn)
+                    stamp = self._stamp(fn)
+                except Exception, e:
+                    print >> stderr, "Couldn't write %s: %s" % (fn, e)
+                    with self._lock:
+                        self._dirty.setdefault(key, value)
+                else:
+                    with self._lock:
+                        if key not in self._dirty:
+                            self._remember(key, stamp, value)
+            with self._lock:
+                self._flushing = {}
+                if fresh and flushing:
+                    self._dirmtime = os.stat(self._basename).st_mtime
+
+_stores = []
+_flushers = {} # interval -> the stores that thread flushes
+
+def _register(store, interval):
+    """
+    Adds the store to those written out by the background flusher for its 
+    interval (and at exit).
+    """
+    _stores.append(store)
+    if interval in _flushers:
+        _flushers[interval].append(store)
+        return
+    stores = _flushers[interval] = [store]
+    def run():
+        while True:
+            time.sleep(interval)
+            for store in list(stores):
+                _flush(store)
+    DaemonThread(target=run, name='jsonfile flush %ss' % interval).start()
+
+def _flush(store):
+    try:
+        store.flush()
+    except Exception, e:
+        print >> stderr, "Couldn't flush %s: %s" % (store._basename, e)
 
+@atexit.register
+def flushall():
+    for store in list(_stores):
+        _flush(store)
@@ -0,0 +1,252 @@
+"""
+The log store appends every change to a per-module log of JSON records, and
+keeps an index of where each key's latest record is.
+
++ Fast writes (always an append)
++ Fast reads (one seek)
++ A crash loses at most the writes since the last sync
+* Readable with normal Unix tools, one record per line
+- Log grows until it's compacted, which takes a copy of the live data
+
+Each line is [key, value], or [key] for a delete. When enough of the log is
+dead records, it's rewritten in the background with just the live ones. Both
+are configurable:
+
+    logstore = {
+        'sync': 1, # How often to fsync, in seconds (0 syncs every write)
+        'garbage': 0.5, # Compact when this much of the log is dead
+        'minsize': 64*1024, # But not before it's this big, in bytes
+    }
+"""
+import collections
+import os, json, threading, time, atexit
+from sys import stderr
+from tools import DaemonThread
+from storebackends import SortedKeys, KeyLocks, ukey
+
+def modulelog(mname):
+    """modulelog(string) -> string
+    Given a name, returns the full path of the log file for that module's
+    store.
+    """
+    return os.path.join(os.path.expanduser('~/.phenny'), mname+'.log')
+
+def _record(key, *value):
+    return json.dumps([key] + list(value)) + '\n'
+
+def _scan(fd, start=0):
+    """
+    Reads the records from start to the end of the file, yielding (offset,
+    length, record) for each, with None for a record that can't be read.
+    Stops before an unfinished record at the very end, which is what a crash
+    in the middle of a write leaves behind.
+    """
+    os.lseek(fd, start, os.SEEK_SET)
+    offset = start
+    buf = ''
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        buf += data
+        lines = buf.split('\n')
+        buf = lines.pop()
+        for line in lines:
+            try:
+                record = json.loads(line)
+                if not isinstance(record, list) or not record:
+                    raise ValueError(line)
+            except ValueError:
+                record = None
+            yield offset, len(line) + 1, record
+            offset += len(line) + 1
+
+class DataStore(SortedKeys, KeyLocks, collections.MutableMapping):
+    """
+    A store based on an append-only log with an in-memory index.
+    """
+    def __init__(self, phenny, module, default):
+        options = getattr(phenny.config, 'logstore', {})
+        self._garbage = options.get('garbage', 0.5)
+        self._minsize = options.get('minsize', 64*1024)
+        self._syncevery = options.get('sync', 1) <= 0
+        self._mname = module.__name__
+        self._fn = modulelog(self._mname)
+        self._lock = threading.RLock()
+        self._compacting = False
+        self._unsynced = False
+
+        exists = os.path.exists(self._fn)
+        self._fd = os.open(self._fn, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        self._load()
+        self._initkeys(self._index)
+        if not exists:
+            self.update(default or {})
+
+        _register(self, options.get('sync', 1))
+
+    def _load(self):
+        self._index = {} # key -> (offset, length)
+        self._size = 0
+        self._live = 0
+        for offset, length, record in _scan(self._fd):
+            if record is None:
+                # Left in place (it's dead weight until the next compaction)
+                # rather than cutting off everything after it
+                print >> stderr, "Skipping an unreadable record at byte %d of %s" % (offset, self._fn)
+            else:
+                self._apply(record, offset, length, self._index)
+            self._size = offset + length
+        if os.fstat(self._fd).st_size > self._size:
+            print >> stderr, "Discarding a partial record at the end of %s" % self._fn
+            os.ftruncate(self._fd, self._size)
+
+    def _apply(self, record, offset, length, index):
+        """
+        Updates index for a record read at offset, keeping the live byte count.
+        """
+        old = index.pop(record[0], None)
+        if old is not None:
+            self._live -= old[1]
+        if len(record) > 1:
+            index[record[0]] = offset, length
+            self._live += length
+
+    def _append(self, key, *value):
+        key = ukey(key)
+        data = _record(key, *value)
+        with self._lock:
+            os.write(self._fd, data)
+            if value and key not in self._index:
+                self._addkey(key)
+            elif not value:
+                self._dropkey(key)
+            self._apply([key] + list(value), self._size, len(data), self._index)
+            self._size += len(data)
+            if self._syncevery:
+                os.fsync(self._fd)
+            else:
+                self._unsynced = True
+            if (self._size >= self._minsize and not self._compacting and
+                    self._size - self._live > self._size * self._garbage):
+                self._compacting = True
+                DaemonThread(target=self.compact, name='logstore compact %s' % self._mname).start()
+
+    def __getitem__(self, key):
+        key = ukey(key)
+        with self._lock:
+            try:
+                offset, length = self._index[key]
+            except KeyError:
+                raise KeyError(key)
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            data = os.read(self._fd, length)
+        return json.loads(data)[1]
+
+    def __setitem__(self, key, value):
+        self._append(key, value)
+
+    def __delitem__(self, key):
+        key = ukey(key)
+        with self._lock:
+            if key not in self._index:
+                raise KeyError(key)
+            self._append(key)
+
+    def __contains__(self, key):
+        return ukey(key) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._index)
+        return iter(keys)
+
+    def flush(self):
+        """
+        Syncs the log to disk.
+        """
+        with self._lock:
+            if self._unsynced:
+                os.fsync(self._fd)
+                self._unsynced = False
+
+    def compact(self):
+        """
+        Rewrites the log with only the live records. Writes carry on while the
+        bulk of it is copied; only the changes made meanwhile are copied with
+        the lock held.
+        """
+        tmp = self._fn + '.compact'
+        try:
+            with self._lock:
+                snapshot = self._index.items()
+                end = self._size
+            reader = os.open(self._fn, os.O_RDONLY)
+            out = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                index = {}
+                size = 0
+                for key, (offset, length) in snapshot:
+                    os.lseek(reader, offset, os.SEEK_SET)
+                    os.write(out, os.read(reader, length))
+                    index[key] = size, length
+                    size += length
+
+                with self._lock:
+                    # Catch up with what's been written since the snapshot
+                    live = self._live
+                    self._live = size
+                    tail = list(_scan(self._fd, end))
+                    os.lseek(self._fd, end, os.SEEK_SET)
+                    os.write(out, os.read(self._fd, self._size - end))
+                    for offset, length, record in tail:
+                        if record is not None:
+                                self._apply(record, size + offset - end, length, index)
+                    size += self._size - end
+                    if self._live != live:
+                        # Shouldn't happen, but don't lose track if it does
+                        print >> stderr, "Live size of %s drifted in compaction" % self._fn
+                    os.fsync(out)
+                    os.rename(tmp, self._fn)
+                    os.close(self._fd)
+                    self._fd = os.open(self._fn, os.O_RDWR | os.O_APPEND)
+                    self._index = index
+                    self._size = size
+                    self._unsynced = False
+            finally:
+                os.close(reader)
+                os.close(out)
+        except Exception, e:
+            print >> stderr, "Couldn't compact %s: %s" % (self._fn, e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        finally:
+            self._compacting = False
+
+_stores = []
+_syncer = None
+
+def _register(store, interval):
+    """
+    Adds the store to those synced by the background thread (and at exit).
+    """
+    global _syncer
+    _stores.append(store)
+    if _syncer is None and interval > 0:
+        def run():
+            while True:
+                time.sleep(interval)
+                syncall()
+        _syncer = DaemonThread(target=run, name='logstore sync')
+        _syncer.start()
+
+@atexit.register
+def syncall():
+    for store in list(_stores):
+        try:
+            store.flush()
+        except Exception, e:
+            print >> stderr, "Couldn't sync %s: %s" % (store._fn, e)
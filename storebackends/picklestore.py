@@ -14,6 +14,7 @@ Implements a primitive pickle-based datastore. Loads on start, saves on exit.
 import collections
 import os, pickle, atexit
 from sys import stderr
+from storebackends import SortedKeys, KeyLocks, ukey
 
 def modulestore(mname):
     """modulestore(string) -> string
@@ -24,7 +25,7 @@ def modulestore(mname):
 
 _stores = []
 
-class DataStore(collections.MutableMapping):
+class DataStore(SortedKeys, KeyLocks, collections.MutableMapping):
     """
     The pickle-based store. Uses an actual dict for the backend.
     """
@@ -39,6 +40,8 @@ class DataStore(collections.MutableMapping):
             self._store = default
         if self._store is None:
             self._store = {}
+        self._store = dict((ukey(k), v) for k, v in self._store.iteritems())
+        self._initkeys(self._store)
         
         # Save ourselves so atexit works
         global _stores
@@ -49,13 +52,18 @@ class DataStore(collections.MutableMapping):
         pickle.dump(self._store, open(self._fn, 'wb')) #FIXME: Fails on __del__
     
     def __getitem__(self, key):
-        return self._store[key]
+        return self._store[ukey(key)]
     
     def __setitem__(self, key, value):
+        key = ukey(key)
+        if key not in self._store:
+            self._addkey(key)
         self._store[key] = value
     
     def __delitem__(self, key):
+        key = ukey(key)
         del self._store[key]
+        self._dropkey(key)
     
     def __len__(self):
         return len(self._store)
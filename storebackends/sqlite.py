@@ -0,0 +1,267 @@
+"""
+The SQLite store keeps every module's data in one table of one database, with
+the values JSON encoded.
+
++ No data loss from crashing (beyond the last moment's writes)
++ Fast, and safe from any thread
++ No external server
++ Live administration with the sqlite3 shell
+- Values must be re-set to be saved, as with the others
+* One file for everything
+
+The database is in write-ahead log mode, and writes are grouped into one
+commit every so often. Both are configurable:
+
+    sqlite = {
+        'path': '~/.phenny/storage.db',
+        'commit': 1, # How often to commit, in seconds
+    }
+"""
+import collections
+import json, threading, time, atexit
+from sys import stderr
+from tools import DaemonThread
+import db
+from storebackends import SortedKeys, KeyLocks, ukey
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS storage (
+    module TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (module, key)
+);
+CREATE TABLE IF NOT EXISTS modules (
+    module TEXT PRIMARY KEY
+);
+"""
+
+_DELETED = object() # Marks a pending delete
+_MISSING = object()
+
+def _next(prefix):
+    """_next(unicode) -> unicode
+    Returns the smallest string greater than everything starting with prefix,
+    for range queries.
+    """
+    while prefix and prefix[-1] == u'\U0010ffff':
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+class DataStore(SortedKeys, KeyLocks, collections.MutableMapping):
+    """
+    A store based on a shared SQLite table.
+
+    Writes are held in memory until the next group commit (or flush()), and
+    reads look there first, so a store always sees its own writes. The ordered
+    queries are done in SQL, on the primary key.
+    """
+    def __init__(self, phenny, module, default):
+        options = getattr(phenny.config, 'sqlite', {})
+        self._mname = module.__name__
+        self._db = _open(options.get('path', '~/.phenny/storage.db'))
+        self._lock = threading.RLock()
+        self._pending = {} # key -> value or _DELETED
+        self._inflight = {} # The same, for writes being committed right now
+
+        with self._db.transaction() as cur:
+            cur.execute("SELECT 1 FROM modules WHERE module=?", (self._mname,))
+            if cur.fetchone() is None:
+                cur.execute("INSERT INTO modules (module) VALUES (?)", (self._mname,))
+                cur.executemany("INSERT OR REPLACE INTO storage (module, key, value) VALUES (?, ?, ?)",
+                    [(self._mname, ukey(k), json.dumps(v)) for k, v in (default or {}).iteritems()])
+
+        _register(self, options.get('commit', 1))
+
+    def _local(self, key):
+        """
+        Returns the uncommitted value for key, _DELETED, or _MISSING if there
+        isn't one. Call with the lock held.
+        """
+        if key in self._pending:
+            return self._pending[key]
+        return self._inflight.get(key, _MISSING)
+
+    def __getitem__(self, key):
+        key = ukey(key)
+        with self._lock:
+            value = self._local(key)
+        if value is _DELETED:
+            raise KeyError(key)
+        elif value is not _MISSING:
+            return value
+        row = self._db.execute("SELECT value FROM storage WHERE module=? AND key=?",
+            (self._mname, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        json.dumps(value) # Fail now rather than at commit
+        with self._lock:
+            self._pending[ukey(key)] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            self._pending[ukey(key)] = _DELETED
+
+    def __contains__(self, key):
+        key = ukey(key)
+        with self._lock:
+            value = self._local(key)
+        if value is not _MISSING:
+            return value is not _DELETED
+        return self._db.execute("SELECT 1 FROM storage WHERE module=? AND key=?",
+            (self._mname, key)).fetchone() is not None
+
+    def _keys(self, where='', params=(), match=None):
+        with self._lock:
+            pending = self._inflight.items() + self._pending.items()
+        keys = set(row[0] for row in self._db.execute(
+            "SELECT key FROM storage WHERE module=?" + where, (self._mname,) + params))
+        for key, value in pending:
+            if match is not None and not match(key):
+                continue
+            if value is _DELETED:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return keys
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def keys_with_prefix(self, prefix):
+        """s.keys_with_prefix(string) -> [string]
+        Returns the keys that start with prefix, in order.
+        """
+        prefix = ukey(prefix)
+        return self._range(prefix, _next(prefix), lambda k: k.startswith(prefix))
+
+    def _range(self, start, stop, match):
+        where, params = '', ()
+        if start is not None:
+            where += " AND key >= ?"
+            params += (start,)
+        if stop is not None:
+            where += " AND key < ?"
+            params += (stop,)
+        return sorted(self._keys(where, params, match))
+
+    def items_in_range(self, start=None, stop=None):
+        """s.items_in_range([string], [string]) -> [(string, object)]
+        Returns the items with start <= key < stop, in key order. Either end
+        may be left open.
+        """
+        start = None if start is None else ukey(start)
+        stop = None if stop is None else ukey(stop)
+        keys = self._range(start, stop, lambda k: (start is None or k >= start) and (stop is None or k < stop))
+        items = []
+        for key in keys:
+            try:
+                items.append((key, self[key]))
+            except KeyError: # Deleted in the meantime
+                pass
+        return items
+
+    def wildcard_matches(self, s, wildcard='*'):
+        """s.wildcard_matches(string, [string]) -> [string]
+        Returns the stored keys that end in wildcard and match s, ie s starts
+        with whatever comes before the wildcard. Shortest first.
+        """
+        s, wildcard = ukey(s), ukey(wildcard)
+        candidates = [s[:n] + wildcard for n in xrange(len(s) + 1)]
+        found = set()
+        # Keep under SQLite's limit on parameters
+        for i in xrange(0, len(candidates), 500):
+            chunk = candidates[i:i+500]
+            found |= self._keys(" AND key IN (%s)" % ','.join('?' * len(chunk)),
+                tuple(chunk), set(chunk).__contains__)
+        return sorted(found, key=len)
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._inflight = pending
+        return pending
+
+    def _done(self):
+        with self._lock:
+            self._inflight = {}
+
+    def _write(self, cur, pending):
+        cur.executemany("DELETE FROM storage WHERE module=? AND key=?",
+            [(self._mname, k) for k, v in pending.iteritems() if v is _DELETED])
+        cur.executemany("INSERT OR REPLACE INTO storage (module, key, value) VALUES (?, ?, ?)",
+            [(self._mname, k, json.dumps(v)) for k, v in pending.iteritems() if v is not _DELETED])
+
+    def _restore(self, pending):
+        # The commit failed; put back what hasn't been overwritten since
+        with self._lock:
+            for key, value in pending.iteritems():
+                self._pending.setdefault(key, value)
+            self._inflight = {}
+
+    def flush(self):
+        """
+        Commits this store's pending writes now.
+        """
+        _commit([self])
+
+_stores = []
+_flusher = None
+_commitlock = threading.Lock()
+
+def _open(path):
+    database = db.open(path)
+    database.executescript(SCHEMA)
+    return database
+
+def _commit(stores):
+    """
+    Writes out the pending changes of the given stores, one transaction per
+    database.
+    """
+    with _commitlock:
+        bydb = {}
+        for store in stores:
+            pending = store._take()
+            if pending:
+                bydb.setdefault(store._db, []).append((store, pending))
+        for database, writes in bydb.iteritems():
+            try:
+                with database.transaction() as cur:
+                    for store, pending in writes:
+                        store._write(cur, pending)
+            except Exception, e:
+                print >> stderr, "Couldn't commit to %s: %s" % (database.path, e)
+                for store, pending in writes:
+                    store._restore(pending)
+            else:
+                for store, pending in writes:
+                    store._done()
+
+def _register(store, interval):
+    """
+    Adds the store to those committed by the background thread (and at exit).
+    """
+    global _flusher
+    _stores.append(store)
+    if _flusher is None:
+        def run():
+            while True:
+                time.sleep(interval)
+                commitall()
+        _flusher = DaemonThread(target=run, name='sqlite commit')
+        _flusher.start()
+
+@atexit.register
+def commitall():
+    _commit(list(_stores))
@@ -0,0 +1,169 @@
+"""
+fakeirc.py - A scripted IRC server for testing Phenny against
+
+The test plays the server: it waits for the lines the bot sends with
+expect(), and answers with send(). The bot runs for real, in its own thread,
+connected over a local socket, with its storage in a scratch ~/.phenny.
+"""
+
+import sys, os, re, time, socket, shutil, tempfile, threading, unittest, Queue
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(root) # bot.py finds modules relative to the working directory
+sys.path.insert(0, root)
+
+SERVER = 'irc.test'
+
+class Config(object):
+    nick = 'testbot'
+    name = 'Phenny Test'
+    password = None
+    prefix = r'\.'
+    channels = ['#test']
+    owner = 'owner'
+    admins = ['owner']
+    enable = []
+    flood = {'burst': 1000, 'base': 0.001}
+    nicktracker = {'interval': 0.01}
+
+class FakeServer(object):
+    """
+    Listens on a local port for a single connection.
+    """
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.conn = None
+        self.lines = [] # Everything the bot has sent so far
+        self.incoming = Queue.Queue()
+
+    def accept(self, timeout=5):
+        self.listener.settimeout(timeout)
+        self.conn, _ = self.listener.accept()
+        self.listener.close()
+        t = threading.Thread(target=self._read, name='FakeServer')
+        t.daemon = True
+        t.start()
+
+    def _read(self):
+        buf = ''
+        while True:
+            try:
+                data = self.conn.recv(4096)
+            except socket.error:
+                data = ''
+            if not data:
+                self.incoming.put(None)
+                return
+            buf += data
+            lines = buf.split('\r\n')
+            buf = lines.pop()
+            for line in lines:
+                self.lines.append(line)
+                self.incoming.put(line)
+
+    def send(self, line):
+        self.conn.sendall(line + '\r\n')
+
+    def expect(self, pattern, timeout=5):
+        """fs.expect(str, [number]) -> match
+        Waits for the bot to send a line matching the pattern (skipping any
+        others), and returns the match.
+        """
+        regexp = re.compile(pattern)
+        end = time.time() + timeout
+        while True:
+            left = end - time.time()
+            try:
+                if left <= 0:
+                    raise Queue.Empty
+                line = self.incoming.get(timeout=left)
+            except Queue.Empty:
+                raise AssertionError("The bot never sent %r" % pattern)
+            if line is None:
+                raise AssertionError("The bot hung up waiting for %r" % pattern)
+            m = regexp.search(line)
+            if m:
+                return m
+
+    def sent(self, pattern):
+        """fs.sent(str) -> [str]
+        Returns the lines sent so far that match the pattern.
+        """
+        regexp = re.compile(pattern)
+        return [line for line in self.lines if regexp.search(line)]
+
+    def close(self):
+        if self.conn is not None:
+            # Hang up for real; the reader thread holds on to the socket
+            self.conn.shutdown(socket.SHUT_RDWR)
+            self.conn.close()
+
+def waitfor(predicate, timeout=5):
+    """
+    Polls until predicate() is true, failing the test if it never is.
+    """
+    end = time.time() + timeout
+    while not predicate():
+        if time.time() > end:
+            raise AssertionError("Gave up waiting for %r" % predicate)
+        time.sleep(0.01)
+
+class IRCTestCase(unittest.TestCase):
+    """
+    Starts a Phenny with the given modules, connected to a FakeServer.
+    """
+    modules = []
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix='phenny-test-')
+        os.mkdir(os.path.join(self.home, '.phenny'))
+        self.oldhome = os.environ.get('HOME')
+        os.environ['HOME'] = self.home
+
+        import bot
+        config = Config()
+        config.enable = list(self.modules)
+        self.bot = bot.Phenny(config)
+        self.server = FakeServer()
+        self.thread = threading.Thread(target=self.bot.run, args=('127.0.0.1', self.server.port))
+        self.thread.daemon = True
+        self.thread.start()
+        self.server.accept()
+
+    def tearDown(self):
+        self.server.close()
+        self.thread.join(5)
+        os.environ['HOME'] = self.oldhome
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def register(self, caps=(), isupport='CHANTYPES=#'):
+        """
+        Goes through connecting: capability negotiation (offering caps),
+        then the welcome and RPL_ISUPPORT.
+        """
+        nick = self.bot.nick
+        if self.bot.wantcaps:
+            self.server.expect(r'^CAP LS')
+        self.server.expect(r'^USER ')
+        if self.bot.wantcaps:
+            self.server.send(':%s CAP * LS :%s' % (SERVER, ' '.join(caps)))
+            if self.bot.wantcaps & set(caps):
+                m = self.server.expect(r'^CAP REQ :(.*)')
+                self.server.send(':%s CAP %s ACK :%s' % (SERVER, nick, m.group(1)))
+            self.server.expect(r'^CAP END')
+        self.server.send(':%s 001 %s :Welcome' % (SERVER, nick))
+        self.server.send(':%s 005 %s %s :are supported by this server' % (SERVER, nick, isupport))
+
+    def join(self, channel, names):
+        """
+        Has the bot join channel, with the given nicks already in it.
+        """
+        nick = self.bot.nick
+        self.bot.write(('JOIN', channel))
+        self.server.expect(r'^JOIN %s' % channel)
+        self.server.send(':%s!bot@example.net JOIN :%s' % (nick, channel))
+        self.server.send(':%s 353 %s = %s :%s %s' % (SERVER, nick, channel, nick, ' '.join(names)))
+        self.server.send(':%s 366 %s %s :End of /NAMES list.' % (SERVER, nick, channel))
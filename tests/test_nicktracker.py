@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+test_nicktracker.py - Tests for account discovery in nicktracker.py
+"""
+
+import unittest
+from fakeirc import IRCTestCase, SERVER, waitfor
+
+NICKSERV = ':NickServ!NickServ@services.'
+
+class CapTest(IRCTestCase):
+    modules = ['nicktracker']
+
+    def test_ack(self):
+        self.server.expect(r'^CAP LS 302')
+        # Split over two lines, as servers do with long lists
+        self.server.send(':%s CAP * LS * :multi-prefix account-notify sasl=PLAIN' % SERVER)
+        self.server.send(':%s CAP * LS :extended-join away-notify' % SERVER)
+        m = self.server.expect(r'^CAP REQ :(.*)')
+        self.assertEqual(sorted(m.group(1).split()), ['account-notify', 'extended-join'])
+        self.server.send(':%s CAP testbot ACK :account-notify extended-join' % SERVER)
+        self.server.expect(r'^CAP END')
+        self.assertEqual(self.bot.caps, set(['account-notify', 'extended-join']))
+
+    def test_nak(self):
+        self.server.expect(r'^CAP LS 302')
+        self.server.send(':%s CAP * LS :account-notify extended-join' % SERVER)
+        self.server.expect(r'^CAP REQ')
+        self.server.send(':%s CAP testbot NAK :account-notify extended-join' % SERVER)
+        self.server.expect(r'^CAP END')
+        self.assertEqual(self.bot.caps, set())
+
+    def test_none_offered(self):
+        self.server.expect(r'^CAP LS 302')
+        self.server.send(':%s CAP * LS :sasl' % SERVER)
+        self.server.expect(r'^CAP END')
+        self.assertEqual(self.server.sent(r'^CAP REQ'), [])
+
+class DiscoveryTest(IRCTestCase):
+    modules = ['nicktracker']
+
+    def lookup(self, nick):
+        row = self.bot.nicktracker.db.execute(
+            "SELECT account, status FROM nickmap WHERE nick=?", (nick,)).fetchone()
+        return row and (row['account'], row['status'])
+
+    def test_whox(self):
+        from nicktracker import LOGGEDIN, LOGGEDOUT, WHOX_TOKEN
+        self.register(isupport='CHANTYPES=# WHOX')
+        self.join('#test', ['alice', 'bob', 'carol'])
+        self.server.expect(r'^WHO #test %%tnuhfa,%s$' % WHOX_TOKEN)
+        for i, (nick, account) in enumerate([('alice', 'alice'), ('bob', '0'), ('carol', 'caroline')]):
+            self.server.send(':%s 354 testbot %s %s host-%i.example.net %s H %s' %
+                (SERVER, WHOX_TOKEN, nick, i, nick, account))
+        self.server.send(':%s 315 testbot #test :End of /WHO list.' % SERVER)
+
+        waitfor(lambda: self.lookup('carol') is not None)
+        self.assertEqual(self.lookup('alice'), ('alice', LOGGEDIN))
+        self.assertEqual(self.lookup('bob'), (None, LOGGEDOUT))
+        self.assertEqual(self.lookup('carol'), ('caroline', LOGGEDIN))
+        # WHOX covered everybody, so NickServ wasn't asked
+        self.assertEqual(self.server.sent(r'PRIVMSG NickServ :ACC (alice|bob|carol) '), [])
+
+    def test_acc_fallback(self):
+        from nicktracker import LOGGEDIN, OFFLINE
+        self.register()
+        self.join('#test', ['alice', 'bob'])
+        asked = set()
+        for i in xrange(2):
+            asked.add(self.server.expect(r'^PRIVMSG NickServ :ACC (\w+) \*$').group(1))
+        self.assertEqual(asked, set(['alice', 'bob']))
+        self.assertEqual(self.server.sent(r'^WHO '), [])
+
+        self.server.send(NICKSERV + ' NOTICE testbot :alice -> alice ACC 3')
+        self.server.send(NICKSERV + ' NOTICE testbot :bob -> * ACC 0 (offline)')
+        waitfor(lambda: self.lookup('alice') is not None and self.lookup('bob') is not None)
+        self.assertEqual(self.lookup('alice'), ('alice', LOGGEDIN))
+        self.assertEqual(self.lookup('bob'), (None, OFFLINE))
+
+if __name__ == '__main__':
+    unittest.main()
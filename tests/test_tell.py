@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+test_tell.py - Tests for delivering tells across nicks
+"""
+
+import unittest
+from fakeirc import IRCTestCase, SERVER, waitfor
+
+NICKSERV = ':NickServ!NickServ@services.'
+
+class AltNickTest(IRCTestCase):
+    modules = ['nicktracker', 'tell']
+
+    def setUp(self):
+        super(AltNickTest, self).setUp()
+        from nicktracker import WHOX_TOKEN
+        self.register(isupport='CHANTYPES=# WHOX')
+        self.join('#test', ['alice', 'bob'])
+        self.server.expect(r'^WHO #test ')
+        for nick in ['alice', 'bob']:
+            self.server.send(':%s 354 testbot %s %s example.net %s H %s' %
+                (SERVER, WHOX_TOKEN, nick, nick, nick))
+        self.server.send(':%s 315 testbot #test :End of /WHO list.' % SERVER)
+        waitfor(lambda: self.bot.nicktracker.lastaccount('bob') == 'bob')
+
+    def test_tell_alt_speak_main(self):
+        import tell
+        # Nobody knows whose alicealt is when the tell is left...
+        self.server.send(':bob!bob@example.net PRIVMSG #test :testbot: tell alicealt the coil is ready')
+        self.server.expect(r"^PRIVMSG #test :bob: I'll pass that on when alicealt is around")
+        self.server.expect(r'^PRIVMSG NickServ :ACC alicealt \*$')
+        # ...until NickServ says it's alice's (although it's not online)
+        self.server.send(NICKSERV + ' NOTICE testbot :alicealt -> alice ACC 0 (offline)')
+        waitfor(lambda: tell.maybe_waiting(['alice']))
+
+        self.server.send(':alice!alice@example.net PRIVMSG #test :morning')
+        self.server.expect(r'^PRIVMSG #test :alicealt: I have the following messages for you:')
+        self.server.expect(r'^PRIVMSG #test :At .*, bob asked me to tell alicealt the coil is ready$')
+        self.assertFalse(tell.maybe_waiting(['alice', 'alicealt']))
+
+    def test_nothing_waiting(self):
+        import tell
+        self.server.send(':bob!bob@example.net PRIVMSG #test :testbot: tell carol hi')
+        self.server.expect(r"^PRIVMSG #test :bob: I'll pass that on when carol is around")
+        self.assertFalse(tell.maybe_waiting(['alice']))
+        self.assertTrue(tell.maybe_waiting(['carol']))
+
+    def test_wildcard(self):
+        import tell
+        self.server.send(':bob!bob@example.net PRIVMSG #test :testbot: tell ali* lunch?')
+        self.server.expect(r"^PRIVMSG #test :bob: I'll pass that on when ali\* is around")
+        self.assertTrue(tell.maybe_waiting(['alice']))
+        self.assertFalse(tell.maybe_waiting(['al']))
+
+        self.server.send(':alice!alice@example.net PRIVMSG #test :hello')
+        self.server.expect(r'^PRIVMSG #test :alice: I have the following messages for you:')
+        self.server.expect(r'^PRIVMSG #test :At .*, bob asked me to tell alice lunch\?$')
+        self.assertFalse(tell.maybe_waiting(['alice']))
+
+if __name__ == '__main__':
+    unittest.main()
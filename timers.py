@@ -0,0 +1,208 @@
+"""
+Timers for modules, shared by the whole bot as phenny.timers.
+
+There's one thread, which sleeps until the next job is due and hands it to
+the worker pool. Jobs are either plain calls, which last only as long as the
+bot does:
+
+    phenny.timers.call_later(60, func, arg)
+    phenny.timers.every(3600, func)
+
+or persistent, which are kept in a DataStore so they survive a restart. For
+these, the module registers a handler by name, and schedules data for it:
+
+    phenny.timers.register('remind', deliver) # deliver(phenny, data)
+    phenny.timers.schedule(when, 'remind', data)
+"""
+import sys, time, heapq, threading, traceback, uuid, numbers
+from tools import DaemonThread
+
+# Persistent jobs that came due while we were down are held back this long
+# after startup, so we're connected by the time they run
+STARTUP_GRACE = 5
+
+# If the worker pool is full and dropping jobs, a due job is tried again this
+# many seconds later
+RETRY = 1
+
+class Job(object):
+    """
+    A scheduled call. Only the scheduler should change one.
+    """
+    __slots__ = ('when', 'func', 'p', 'kw', 'interval', 'name', 'ident', 'data', 'cancelled')
+
+    def __init__(self, when, func=None, p=(), kw=None, interval=None, name=None, ident=None, data=None):
+        self.when = when
+        self.func = func
+        self.p = p
+        self.kw = kw or {}
+        self.interval = interval
+        self.name = name
+        self.ident = ident
+        self.data = data
+        self.cancelled = False
+
+    def __repr__(self):
+        if self.name is not None:
+            what = self.name
+        else:
+            what = getattr(self.func, '__name__', repr(self.func))
+        return "<Job %s at %s>" % (what, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.when)))
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+class Scheduler(object):
+    """
+    A min-heap of jobs by due time, run on the bot's worker pool.
+
+    A job that returns a number (that isn't a bool) is run again that many
+    seconds later. A job the pool drops (because it's full) is tried again
+    RETRY seconds later.
+    """
+    def __init__(self, phenny):
+        self.phenny = phenny
+        self.heap = []
+        self.handlers = {} # name -> func(phenny, data)
+        self.waiting = {} # name -> [Job], persistent jobs without a handler yet
+        self.cond = threading.Condition()
+        self.thread = None
+        self.store = phenny.DataStore(phenny, sys.modules[__name__], {})
+        self._load()
+
+    def _load(self):
+        earliest = time.time() + STARTUP_GRACE
+        for ident in list(self.store):
+            try:
+                when, name, data = self.store[ident]
+            except (KeyError, ValueError):
+                continue
+            job = Job(max(when, earliest), name=name, ident=ident, data=data)
+            self.waiting.setdefault(name, []).append(job)
+
+    def _push(self, job):
+        with self.cond:
+            heapq.heappush(self.heap, job)
+            if self.thread is None:
+                self.thread = DaemonThread(target=self._run, name='Timers')
+                self.thread.start()
+            self.cond.notify()
+        return job
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.heap and self.heap[0].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                delay = self.heap[0].when - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                job = heapq.heappop(self.heap)
+            if not self.phenny.pool.submit(job.name or getattr(job.func, '__module__', None), self._fire, job):
+                # Don't lose it (it may be persistent, or repeating)
+                job.when = time.time() + RETRY
+                self._push(job)
+
+    def _fire(self, job):
+        if job.cancelled:
+            return
+        try:
+            if job.name is not None:
+                rv = self.handlers[job.name](self.phenny, job.data)
+            else:
+                rv = job.func(*job.p, **job.kw)
+        except Exception:
+            print >> sys.stderr, "Error in timer %r:" % job
+            traceback.print_exc()
+            rv = None
+
+        if job.cancelled:
+            return
+        if isinstance(rv, numbers.Real) and not isinstance(rv, bool):
+            job.when = time.time() + rv
+        elif job.interval is not None:
+            job.when = max(job.when + job.interval, time.time())
+        else:
+            if job.ident is not None:
+                self._forget(job)
+            return
+        if job.ident is not None:
+            self.store[job.ident] = [job.when, job.name, job.data]
+        self._push(job)
+
+    def _forget(self, job):
+        try:
+            del self.store[job.ident]
+        except KeyError:
+            pass
+
+    def call_at(self, when, func, *p, **kw):
+        """s.call_at(number, callable, ...) -> Job
+        Calls func(*p, **kw) at the given time.
+        """
+        return self._push(Job(when, func, p, kw))
+
+    def call_later(self, delay, func, *p, **kw):
+        """s.call_later(number, callable, ...) -> Job
+        Calls func(*p, **kw) in delay seconds.
+        """
+        return self._push(Job(time.time() + delay, func, p, kw))
+
+    def every(self, interval, func, *p, **kw):
+        """s.every(number, callable, ...) -> Job
+        Calls func(*p, **kw) every interval seconds, starting interval seconds
+        from now.
+        """
+        return self._push(Job(time.time() + interval, func, p, kw, interval=interval))
+
+    def register(self, name, func):
+        """s.register(str, callable)
+        Sets the handler for persistent jobs with the given name, and lets any
+        that were loaded from storage run.
+        """
+        with self.cond:
+            self.handlers[name] = func
+            jobs = self.waiting.pop(name, [])
+        for job in jobs:
+            self._push(job)
+
+    def schedule(self, when, name, data=None):
+        """s.schedule(number, str, [object]) -> Job
+        Runs the handler registered as name with data at the given time, even
+        if the bot is restarted in between. Data must be JSON-able.
+        """
+        ident = uuid.uuid4().hex
+        job = Job(when, name=name, ident=ident, data=data)
+        self.store[ident] = [when, name, data]
+        with self.cond:
+            if name not in self.handlers:
+                self.waiting.setdefault(name, []).append(job)
+                return job
+        return self._push(job)
+
+    def cancel(self, job):
+        """s.cancel(Job)
+        Stops the job from running (again).
+        """
+        job.cancelled = True
+        if job.ident is not None:
+            self._forget(job)
+        with self.cond:
+            self.cond.notify()
+
+    def list(self, name=None):
+        """s.list([str]) -> [Job]
+        Returns the pending jobs, soonest first. If a name is given, only the
+        persistent jobs with that name.
+        """
+        with self.cond:
+            jobs = [j for j in self.heap if not j.cancelled]
+            for waiting in self.waiting.itervalues():
+                jobs += waiting
+        if name is not None:
+            jobs = [j for j in jobs if j.name == name]
+        return sorted(jobs, key=lambda j: j.when)
@@ -6,7 +6,7 @@ Licensed under the Eiffel Forum License 2.
 
 http://inamidst.com/phenny/
 """
-import collections, time, threading, warnings, sys, traceback
+import collections, time, threading, warnings, sys, traceback, bisect
 
 def deprecated(old): 
    fname = "%s.%s" % (old.__module__, old.__name__)
@@ -44,6 +44,377 @@ def startdaemon(func, *p, **kw):
     t.start()
     return t
 
+class Future(object):
+    """
+    The result of a call running on another thread, once it's finished.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None # sys.exc_info() of what it raised
+    
+    def __repr__(self):
+        state = 'done' if self._done.is_set() else 'pending'
+        return "<Future %s>" % state
+    
+    def set_result(self, value):
+        self._result = value
+        self._done.set()
+    
+    def set_error(self, exc_info):
+        self._error = exc_info
+        self._done.set()
+    
+    def done(self):
+        return self._done.is_set()
+    
+    def wait(self, timeout=None):
+        """f.wait([number]) -> bool
+        Waits for the call to finish. Returns False if the timeout ran out first.
+        """
+        return self._done.wait(timeout)
+    
+    def result(self, timeout=None):
+        """f.result([number]) -> object
+        Waits for the call to finish, and returns what it returned, or raises 
+        what it raised. Raises Timeout if the timeout runs out first.
+        """
+        if not self._done.wait(timeout):
+            raise Timeout("Gave up waiting after %rs" % timeout)
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class Timeout(Exception):
+    pass
+
+class WorkerPool(object):
+    """
+    A fixed set of daemon threads that run jobs from a bounded queue, so that 
+    bursts of work don't turn into bursts of threads.
+    
+    Every job is submitted with a key (normally the module name). Keys can be 
+    capped to a number of jobs in progress at once; jobs over their cap wait 
+    in the queue without tying up a worker.
+    
+    When the queue is full, the overflow policy decides what happens:
+     * 'drop': The job is discarded (and counted).
+     * 'block': The caller waits until there is room. (Except when the caller 
+       is one of the workers, which runs the job inline instead; otherwise a 
+       full queue of jobs that submit jobs would have every worker waiting on 
+       the others.)
+     * 'inline': The job is run right away in the caller's thread.
+    
+    Other notes:
+     * Workers are started on the first submit.
+     * Any errors thrown by jobs are printed and swallowed.
+    """
+    OVERFLOW = ('drop', 'block', 'inline')
+    def __init__(self, threads=8, queue=256, overflow='drop', caps=None):
+        """WorkerPool([int], [int], [str], [dict])
+        * threads is the number of worker threads.
+        * queue is how many jobs may be waiting before overflow kicks in.
+        * overflow is the overflow policy, one of WorkerPool.OVERFLOW.
+        * caps maps keys to the most jobs they may have in progress.
+        """
+        if overflow not in self.OVERFLOW:
+            raise ValueError("Unknown overflow policy: %r" % overflow)
+        self.threads = threads
+        self.maxqueue = queue
+        self.overflow = overflow
+        self.caps = dict(caps or {})
+        self._cond = threading.Condition()
+        self._ready = collections.deque() # Jobs a worker may pick up
+        self._held = {} # key -> deque of jobs waiting on the key's cap
+        self._active = {} # key -> number of jobs ready or running
+        self._depth = 0 # Jobs waiting, ready or held
+        self._busy = 0 # Workers running a job
+        self._workers = []
+        self.counters = dict.fromkeys(['submitted', 'completed', 'dropped', 
+            'inline', 'blocked', 'errors', 'maxdepth'], 0)
+    
+    def __repr__(self):
+        return "<WorkerPool threads=%i busy=%i depth=%i>" % (len(self._workers), self._busy, self._depth)
+    
+    def _start(self):
+        """
+        Spins up the workers. Must hold the lock.
+        """
+        while len(self._workers) < self.threads:
+            t = DaemonThread(target=self._work, name='WorkerPool-%i' % len(self._workers))
+            self._workers.append(t)
+            t.start()
+    
+    def _run(self, func, p, kw):
+        try:
+            func(*p, **kw)
+        except KeyboardInterrupt:
+            raise
+        except:
+            with self._cond:
+                self.counters['errors'] += 1
+            print >> sys.stderr, "Error in pooled job %r, ignoring." % func
+            traceback.print_exc()
+    
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key, func, p, kw = self._ready.popleft()
+                self._depth -= 1
+                self._busy += 1
+                self._cond.notify_all() # There's room in the queue now
+            
+            try:
+                self._run(func, p, kw)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self.counters['completed'] += 1
+                    self._active[key] -= 1
+                    held = self._held.get(key)
+                    if held:
+                        self._active[key] += 1
+                        self._ready.append(held.popleft())
+                    self._cond.notify_all()
+    
+    def submit(self, key, func, *p, **kw):
+        """wp.submit(key, callable, ...) -> bool
+        Queues func to be called with the given arguments. Returns False if the 
+        job was dropped.
+        """
+        job = (key, func, p, kw)
+        with self._cond:
+            self.counters['submitted'] += 1
+            if not self._workers:
+                self._start()
+            
+            if self._depth >= self.maxqueue:
+                if self.overflow == 'drop':
+                    self.counters['dropped'] += 1
+                    print >> sys.stderr, "Worker queue full, dropped %r" % func
+                    return False
+                elif self.overflow == 'inline' or threading.current_thread() in self._workers:
+                    self.counters['inline'] += 1
+                    inline = True
+                else:
+                    self.counters['blocked'] += 1
+                    while self._depth >= self.maxqueue:
+                        self._cond.wait()
+                    inline = False
+            else:
+                inline = False
+            
+            if not inline:
+                self._depth += 1
+                self.counters['maxdepth'] = max(self.counters['maxdepth'], self._depth)
+                cap = self.caps.get(key)
+                active = self._active.get(key, 0)
+                if cap is not None and active >= cap:
+                    self._held.setdefault(key, collections.deque()).append(job)
+                else:
+                    self._active[key] = active + 1
+                    self._ready.append(job)
+                    self._cond.notify()
+                return True
+        
+        # Out of the lock
+        self._run(func, p, kw)
+        return True
+    
+    def future(self, key, func, *p, **kw):
+        """wp.future(key, callable, ...) -> Future
+        Like submit(), but returns a Future for the result. If the job is 
+        dropped, the Future raises RuntimeError.
+        """
+        future = Future()
+        def call():
+            try:
+                future.set_result(func(*p, **kw))
+            except:
+                future.set_error(sys.exc_info())
+        if not self.submit(key, call):
+            future.set_error((RuntimeError, RuntimeError("Worker queue full"), None))
+        return future
+    
+    def join(self, timeout=None):
+        """wp.join([number]) -> bool
+        Waits until there is no queued or running work. Returns False if the 
+        timeout ran out first.
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._depth or self._busy:
+                if end is None:
+                    self._cond.wait()
+                else:
+                    left = end - time.time()
+                    if left <= 0:
+                        return False
+                    self._cond.wait(left)
+        return True
+    
+    def stats(self):
+        """wp.stats() -> dict
+        Returns a snapshot of the pool's counters and queue.
+        """
+        with self._cond:
+            rv = dict(self.counters)
+            rv.update({
+                'threads': len(self._workers),
+                'busy': self._busy,
+                'depth': self._depth,
+                'held': dict((k, len(v)) for k, v in self._held.iteritems() if v),
+                'active': dict((k, v) for k, v in self._active.iteritems() if v),
+                })
+            return rv
+
+class Histogram(object):
+    """
+    A fixed-size histogram of durations, in power-of-two millisecond buckets 
+    (the first is everything under 1ms, the last everything over a minute).
+    
+    No knowledge of threading; callers do their own locking.
+    """
+    BOUNDS = [2 ** i / 1000.0 for i in range(17)] # 1ms .. 65.5s
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def __repr__(self):
+        return "<Histogram n=%i p50=%r max=%r>" % (self.count, self.percentile(50), self.max)
+    
+    def add(self, seconds):
+        """h.add(number)
+        Records a duration.
+        """
+        i = bisect.bisect_left(self.BOUNDS, seconds)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, p):
+        """h.percentile(number) -> number|None
+        Returns an upper bound for the pth percentile, in seconds.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                if i < len(self.BOUNDS):
+                    return min(self.BOUNDS[i], self.max)
+                break
+        return self.max
+    
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+    
+    def todict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': list(self.buckets),
+            }
+
+class HandlerStats(object):
+    """
+    Performance figures for one handler: calls, errors, how many are running 
+    right now, and histograms of run time and time spent waiting in a queue.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.inflight = 0
+        self.time = Histogram()
+        self.wait = Histogram()
+    
+    def __repr__(self):
+        return "<HandlerStats calls=%i errors=%i inflight=%i>" % (self.calls, self.errors, self.inflight)
+    
+    def todict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'inflight': self.inflight,
+            'time': self.time.todict(),
+            'wait': self.wait.todict(),
+            }
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe cache. Once it holds size entries, the least 
+    recently used goes to make room. If ttl is given, entries older than that 
+    many seconds count as missing.
+    """
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict() # key -> (stored, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+    
+    def __repr__(self):
+        return "<LRUCache %i/%i hits=%i misses=%i>" % (len(self._data), self.size, self.hits, self.misses)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        """c.get(key, [default]) -> value
+        Returns the cached value, or default if there isn't a fresh one.
+        """
+        with self._lock:
+            try:
+                stored, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                self.misses += 1
+                return default
+            self._data[key] = stored, value
+            self.hits += 1
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = time.time(), value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
+
 class TimeTrackDict(collections.MutableMapping):
     """
     A dictionary that keeps track of the freshness of it's data. If data is 
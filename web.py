@@ -5,8 +5,11 @@ Author: Sean B. Palmer, inamidst.com
 About: http://inamidst.com/phenny/
 """
 
-import re, urllib
+import re, os, sys, urllib, urlparse, httplib, socket, threading, time, zlib
+import hashlib, pickle, email.utils, base64, json as jsonlib, random
+from StringIO import StringIO
 from htmlentitydefs import name2codepoint
+from tools import LRUCache, WorkerPool
 
 class Grab(urllib.URLopener): 
    def __init__(self, *args): 
@@ -16,29 +19,682 @@ class Grab(urllib.URLopener):
       return urllib.addinfourl(fp, [headers, errcode], "http:" + url)
 urllib._urlopener = Grab()
 
-def get(uri): 
+# Client settings; see configure()
+options = {
+   'connect': 10, # Seconds to wait for a connection
+   'timeout': 30, # Seconds to wait for each read
+   'deadline': 60, # Seconds for the whole response
+   'maxsize': 4 * 1024 * 1024, # Bytes of (decoded) body to allow
+   'idle': 4, # Idle connections to keep per host
+   'keepalive': 60, # Seconds to keep an idle connection
+   'redirects': 5, # Redirects to follow
+   'cache': 256, # Responses to keep in memory for get() (0 turns it off)
+   'disk': None, # A directory to keep them in as well, eg ~/.phenny/webcache
+   'diskentries': 4096, # How many to keep there
+   'cacheable': 512 * 1024, # The largest body worth caching, in bytes
+   'fetchers': 8, # Threads for submit() and fetch_many()
+   'delay': 0, # Seconds between starting requests to the same host
+   'delays': { # The same, for particular hosts
+      'ajax.googleapis.com': 0.25, 
+   }, 
+   'record': None, # A fixture file to record every response to
+   'replay': None, # A fixture file to answer every request from instead
+   'latency': 0, # Seconds to wait before each replayed response
+   'jitter': 0, # Up to this many more, at random
+}
+
+def configure(config): 
+   """configure(dict)
+   Changes the client settings (from the bot's config.web).
+   """
+   options.update(config or {})
+   cache.memory.size = options['cache']
+   fetchers.threads = options['fetchers']
+   if options['replay']: 
+      use(Replayer(options['replay'], options['latency'], options['jitter']))
+   elif options['record']: 
+      use(Recorder(options['record']))
+
+class TooLarge(IOError): 
+   """The response body was bigger than the maxsize option."""
+
+class TooManyRedirects(IOError): 
+   """More redirects than the redirects option allows."""
+
+class Pool(object): 
+   """
+   Idle keep-alive connections, by (scheme, host, port).
+   """
+   def __init__(self): 
+      self.lock = threading.Lock()
+      self.idle = {} # key -> [(conn, time)]
+
+   def get(self, key): 
+      """
+      Returns an idle connection for key, or None.
+      """
+      now = time.time()
+      with self.lock: 
+         conns = self.idle.get(key, [])
+         while conns: 
+            conn, when = conns.pop()
+            if now - when < options['keepalive']: 
+               return conn
+            conn.close()
+      return None
+
+   def put(self, key, conn): 
+      with self.lock: 
+         conns = self.idle.setdefault(key, [])
+         if len(conns) < options['idle']: 
+            conns.append((conn, time.time()))
+            return
+      conn.close()
+
+   def clear(self): 
+      with self.lock: 
+         idle, self.idle = self.idle, {}
+      for conns in idle.itervalues(): 
+         for conn, when in conns: 
+            conn.close()
+
+pool = Pool()
+
+class Response(object): 
+   """
+   An HTTP response, read as it comes in. The body is decompressed if the 
+   server compressed it. Close it (or read it to the end) when done, so the 
+   connection can be used again.
+   """
+   def __init__(self, key, conn, resp, url, reused): 
+      self.key = key
+      self.conn = conn
+      self.resp = resp
+      self.url = url
+      self.reused = reused
+      self.status = resp.status
+      self.reason = resp.reason
+      self.headers = resp.msg
+      self.started = time.time()
+      self.size = 0
+      self.done = False
+
+      encoding = (resp.getheader('content-encoding') or '').lower()
+      if encoding in ('gzip', 'x-gzip'): 
+         self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      elif encoding == 'deflate': 
+         self.decoder = zlib.decompressobj()
+      else: self.decoder = None
+
+   def _decode(self, data): 
+      if self.decoder is None: 
+         return data
+      try: return self.decoder.decompress(data)
+      except zlib.error: 
+         if self.size or self.headers.get('content-encoding') != 'deflate': 
+            raise IOError('Bad compressed data from %s' % self.url)
+         # Some servers send raw deflate without the zlib header
+         self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+         return self.decoder.decompress(data)
+
+   def read(self, size=None): 
+      """r.read([int]) -> str
+      Reads up to size bytes of the body, or all the rest of it.
+      """
+      chunks = []
+      wanted = size
+      while not self.done and (wanted is None or wanted > 0): 
+         if time.time() - self.started > options['deadline']: 
+            self.close()
+            raise socket.timeout('Took too long to read %s' % self.url)
+         try: data = self.resp.read(8192 if wanted is None else min(wanted, 8192))
+         except (httplib.HTTPException, ValueError), e: 
+            self.close()
+            raise IOError('Error reading %s: %r' % (self.url, e))
+         except: 
+            self.close()
+            raise
+         if not data: 
+            if self.decoder is not None: 
+               chunks.append(self.decoder.flush())
+            self.finish()
+            break
+         data = self._decode(data)
+         self.size += len(data)
+         if self.size > options['maxsize']: 
+            self.close()
+            raise TooLarge('%s is over %i bytes' % (self.url, options['maxsize']))
+         chunks.append(data)
+         if wanted is not None: 
+            wanted -= len(data)
+      return ''.join(chunks)
+
+   def __iter__(self): 
+      while True: 
+         data = self.read(8192)
+         if not data: 
+            break
+         yield data
+
+   def finish(self): 
+      # Read to the end, so the connection can go back in the pool
+      self.done = True
+      if self.conn is not None: 
+         if self.resp.will_close: 
+            self.conn.close()
+         else: pool.put(self.key, self.conn)
+         self.conn = None
+
+   def close(self): 
+      self.done = True
+      if self.conn is not None: 
+         self.conn.close()
+         self.conn = None
+
+   def __enter__(self): 
+      return self
+
+   def __exit__(self, *exc): 
+      self.close()
+
+# host -> when the next request to it may start
+turns = {}
+turnlock = threading.Lock()
+
+def polite(host): 
+   """
+   Waits until it's our turn to make a request to the host, by the delay 
+   options, so that however many threads are fetching, a host never gets 
+   requests faster than it's meant to.
+   """
+   delay = options['delays'].get(host, options['delay'])
+   if not delay: 
+      return
+   with turnlock: 
+      now = time.time()
+      when = max(now, turns.get(host, 0))
+      turns[host] = when + delay
+   if when > now: 
+      time.sleep(when - now)
+
+def connect(scheme, host, port): 
+   if scheme == 'https': 
+      conn = httplib.HTTPSConnection(host, port, timeout=options['connect'])
+   else: conn = httplib.HTTPConnection(host, port, timeout=options['connect'])
+   conn.connect()
+   conn.sock.settimeout(options['timeout'])
+   return conn
+
+def send(method, url, body=None, headers=None): 
+   """send(str, str, [str], [dict]) -> Response
+   Makes one request, on a pooled connection if there is one.
+   """
+   parsed = urlparse.urlsplit(url)
+   scheme = parsed.scheme.lower()
+   if scheme not in ('http', 'https'): 
+      raise IOError('Not an HTTP URI: %s' % url)
+   try: port = parsed.port
+   except ValueError: 
+      raise httplib.InvalidURL('Bad port in %s' % url)
+   host = parsed.hostname
+   if not host: 
+      raise httplib.InvalidURL('No host in %s' % url)
+   port = port or (443 if scheme == 'https' else 80)
+   key = (scheme, host, port)
+   path = parsed.path or '/'
+   if parsed.query: 
+      path += '?' + parsed.query
+
+   allheaders = {
+      'User-Agent': 'Mozilla/5.0 (Phenny)', 
+      'Accept-Encoding': 'gzip, deflate', 
+   }
+   allheaders.update(headers or {})
+
+   polite(host)
+   conn = pool.get(key)
+   reused = conn is not None
+   while True: 
+      if conn is None: 
+         conn = connect(scheme, host, port)
+      try: 
+         conn.request(method, path, body, allheaders)
+         resp = conn.getresponse()
+      except (socket.error, httplib.HTTPException), e: 
+         conn.close()
+         if reused and method in ('GET', 'HEAD'): 
+            # The server probably dropped the idle connection; try a new one
+            conn, reused = None, False
+            continue
+         if isinstance(e, httplib.HTTPException): 
+            raise IOError('Error fetching %s: %r' % (url, e))
+         raise
+      return Response(key, conn, resp, url, reused)
+
+class Network(object): 
+   """
+   The usual transport: real requests over the network.
+   """
+   def send(self, method, url, body=None, headers=None): 
+      return send(method, url, body, headers)
+
+class Canned(object): 
+   """
+   A response that's already entirely in memory, as from a fixture. Reads 
+   like a Response.
+   """
+   def __init__(self, url, status, reason, headers, body): 
+      self.url = url
+      self.status = status
+      self.reason = reason
+      lines = ''.join('%s: %s\r\n' % (k, v) for k, v in headers)
+      self.headers = httplib.HTTPMessage(StringIO(lines + '\r\n'))
+      self.body = StringIO(body)
+
+   def read(self, size=None): 
+      if size is None: 
+         return self.body.read()
+      return self.body.read(size)
+
+   def __iter__(self): 
+      while True: 
+         data = self.read(8192)
+         if not data: 
+            break
+         yield data
+
+   def finish(self): 
+      pass
+
+   def close(self): 
+      pass
+
+   def __enter__(self): 
+      return self
+
+   def __exit__(self, *exc): 
+      self.close()
+
+class Fixtures(object): 
+   """
+   Recorded responses, kept in a JSON file: a list of records with the 
+   method, URL and request body, and the status, reason, headers and body of 
+   the response. Bodies are base64 encoded.
+   """
+   def __init__(self, path): 
+      self.path = os.path.expanduser(path)
+      self.lock = threading.Lock()
+      self.records = {} # (method, normalized url, request body) -> record
+      if os.path.exists(self.path): 
+         with open(self.path) as f: 
+            for record in jsonlib.load(f): 
+               self.records[self.key(record)] = record
+
+   def key(self, record): 
+      return record['method'], normalize(record['url']), record['request'] or ''
+
+   def get(self, method, url, body): 
+      return self.records.get(self.key({'method': method, 'url': url, 
+         'request': body and base64.b64encode(body)}))
+
+   def add(self, record): 
+      with self.lock: 
+         self.records[self.key(record)] = record
+         records = sorted(self.records.values(), key=lambda r: (r['url'], r['method']))
+         with open(self.path + '~', 'w') as f: 
+            jsonlib.dump(records, f, indent=1)
+         os.rename(self.path + '~', self.path)
+
+   def response(self, record): 
+      return Canned(record['url'], record['status'], record['reason'], 
+         record['headers'], base64.b64decode(record['body']))
+
+class Recorder(object): 
+   """
+   A transport that makes real requests (through another transport), and 
+   records the responses as fixtures.
+   """
+   def __init__(self, path, transport=None): 
+      self.fixtures = Fixtures(path)
+      self.transport = transport or Network()
+
+   def send(self, method, url, body=None, headers=None): 
+      with self.transport.send(method, url, body, headers) as r: 
+         data = r.read()
+      # The body's already been decoded, and it'll be replayed in one piece
+      headers = [(k, v) for k, v in r.headers.items() 
+         if k not in ('content-encoding', 'transfer-encoding', 'content-length')]
+      if r.headers.get('content-length') is not None: 
+         headers.append(('content-length', str(len(data))))
+      if r.status == 304: 
+         # Only good for revalidating; keep the full response we had
+         return Canned(url, r.status, r.reason, headers, data)
+      record = {
+         'method': method, 'url': url, 
+         'request': body and base64.b64encode(body), 
+         'status': r.status, 'reason': r.reason, 
+         'headers': headers, 'body': base64.b64encode(data), 
+      }
+      self.fixtures.add(record)
+      return self.fixtures.response(record)
+
+class Replayer(object): 
+   """
+   A transport that answers from recorded fixtures instead of the network, 
+   after latency seconds (plus up to jitter more), to stand in for a real 
+   round trip. Requests with no fixture raise IOError.
+   """
+   def __init__(self, path, latency=0, jitter=0): 
+      self.fixtures = Fixtures(path)
+      self.latency = latency
+      self.jitter = jitter
+
+   def send(self, method, url, body=None, headers=None): 
+      record = self.fixtures.get(method, url, body)
+      delay = self.latency + random.random() * self.jitter
+      if delay: 
+         time.sleep(delay)
+      if record is None: 
+         raise IOError('No fixture for %s %s' % (method, url))
+      return self.fixtures.response(record)
+
+transport = Network()
+
+def use(t): 
+   """use(transport)
+   Sends every request through the given transport (anything with a send() 
+   like Network's) from now on.
+   """
+   global transport
+   transport = t
+
+def request(uri, method='GET', body=None, headers=None, follow=True, redirects=None): 
+   """request(str, [str], [str], [dict], [bool], [int]) -> Response
+   Requests the URI, following redirects unless told not to (up to redirects 
+   of them, or the redirects option), and returns the response for reading.
+   """
+   if redirects is None: 
+      redirects = options['redirects']
+   for i in xrange(redirects + 1): 
+      response = transport.send(method, uri, body, headers)
+      location = response.headers.get('location')
+      if not follow or response.status not in (301, 302, 303, 307, 308) or not location: 
+         return response
+      try: length = int(response.headers.get('content-length') or 65536)
+      except ValueError: length = 65536
+      if length < 65536: 
+         response.read() # Small enough to keep the connection
+      response.close()
+      uri = urlparse.urljoin(uri, location)
+      if response.status in (301, 302, 303) and method != 'HEAD': 
+         method, body = 'GET', None
+   raise TooManyRedirects('Too many redirects from %s' % uri)
+
+class Cache(object): 
+   """
+   Responses to GETs, kept while they're fresh by Cache-Control or Expires (or 
+   the caller's ttl), and revalidated with ETag or Last-Modified after that.
+   """
+   def __init__(self): 
+      self.memory = LRUCache(options['cache'])
+      self.lock = threading.Lock()
+      self.hits = self.revalidated = self.misses = 0
+      self.saved = 0 # Bytes we didn't have to download
+      self.diskwrites = 0
+
+   def _path(self, uri): 
+      if isinstance(uri, unicode): 
+         uri = uri.encode('utf-8')
+      return os.path.join(os.path.expanduser(options['disk']), hashlib.sha1(uri).hexdigest())
+
+   def lookup(self, uri): 
+      entry = self.memory.get(uri)
+      if entry is None and options['disk']: 
+         try: 
+            with open(self._path(uri), 'rb') as f: 
+               entry = pickle.load(f)
+         except (IOError, EOFError, pickle.UnpicklingError): 
+            return None
+         if entry.get('uri') != uri: 
+            return None
+         self.memory.set(uri, entry)
+      return entry
+
+   def store(self, uri, entry): 
+      self.memory.set(uri, entry)
+      if not options['disk']: 
+         return
+      path = self._path(uri)
+      try: 
+         directory = os.path.dirname(path)
+         if not os.path.isdir(directory): 
+            os.makedirs(directory)
+         with open(path + '~', 'wb') as f: 
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+         os.rename(path + '~', path)
+      except (IOError, OSError), e: 
+         print "Couldn't cache %s: %s" % (uri, e)
+         return
+      with self.lock: 
+         self.diskwrites += 1
+         prune = self.diskwrites % 100 == 0
+      if prune: 
+         self.prune(directory)
+
+   def prune(self, directory): 
+      # Throw out the oldest files once there are too many
+      try: 
+         names = os.listdir(directory)
+         if len(names) <= options['diskentries']: 
+            return
+         paths = [os.path.join(directory, name) for name in names]
+         paths.sort(key=lambda p: os.path.getmtime(p))
+         for path in paths[:len(paths) - options['diskentries']]: 
+            os.remove(path)
+      except OSError: 
+         pass
+
+   def expires(self, headers, now, ttl): 
+      """
+      Returns when a response stops being fresh, or None if it mustn't be 
+      stored at all.
+      """
+      control = {}
+      for directive in (headers.get('cache-control') or '').split(','): 
+         name, _, value = directive.strip().partition('=')
+         control[name.lower()] = value.strip('"')
+      if 'no-store' in control: 
+         return None
+      if ttl is not None: 
+         return now + ttl
+      if 'no-cache' in control: 
+         return now
+      for name in ('s-maxage', 'max-age'): 
+         if control.get(name, '').isdigit(): 
+            return now + int(control[name])
+      expires = headers.get('expires')
+      if expires: 
+         expires = email.utils.parsedate_tz(expires)
+         date = email.utils.parsedate_tz(headers.get('date') or '')
+         if expires is None: 
+            return now # Invalid, which means already expired
+         expires = email.utils.mktime_tz(expires)
+         if date is not None: 
+            # Go by the server's clock, not ours
+            expires += now - email.utils.mktime_tz(date)
+         return expires
+      return now
+
+   def fetch(self, uri, ttl=None): 
+      now = time.time()
+      entry = self.lookup(uri)
+      if entry is not None and now < entry['expires']: 
+         with self.lock: 
+            self.hits += 1
+            self.saved += len(entry['body'])
+         return entry['body']
+
+      headers = {}
+      if entry is not None: 
+         if entry['etag']: 
+            headers['If-None-Match'] = entry['etag']
+         if entry['modified']: 
+            headers['If-Modified-Since'] = entry['modified']
+      with request(uri, headers=headers) as u: 
+         if u.status == 304 and entry is not None: 
+            u.read()
+            expires = self.expires(u.headers, now, ttl)
+            if expires is not None: 
+               self.store(uri, dict(entry, expires=expires))
+            with self.lock: 
+               self.revalidated += 1
+               self.saved += len(entry['body'])
+            return entry['body']
+         bytes = u.read()
+         status, info = u.status, u.headers
+
+      with self.lock: 
+         self.misses += 1
+      if status == 200 and len(bytes) <= options['cacheable']: 
+         expires = self.expires(info, now, ttl)
+         etag, modified = info.get('etag'), info.get('last-modified')
+         if expires is not None and (expires > now or etag or modified): 
+            self.store(uri, {
+               'uri': uri, 'body': bytes, 'expires': expires, 
+               'etag': etag, 'modified': modified, 
+            })
+      return bytes
+
+   def stats(self): 
+      with self.lock: 
+         return {
+            'hits': self.hits, 
+            'revalidated': self.revalidated, 
+            'misses': self.misses, 
+            'saved': self.saved, 
+            'memory': len(self.memory), 
+         }
+
+cache = Cache()
+
+def normalize(uri): 
+   """normalize(str) -> str
+   Returns the URI in a canonical form, for telling whether two URIs are the 
+   same resource: lowercase scheme and host, no default port or fragment.
+   """
+   parsed = urlparse.urlsplit(uri)
+   scheme = parsed.scheme.lower()
+   netloc = (parsed.hostname or '').lower()
+   try: port = parsed.port
+   except ValueError: 
+      return uri
+   if port and port != {'http': 80, 'https': 443}.get(scheme): 
+      netloc += ':%i' % port
+   if parsed.username is not None: 
+      netloc = parsed.netloc.rsplit('@', 1)[0] + '@' + netloc
+   return urlparse.urlunsplit((scheme, netloc, parsed.path or '/', parsed.query, ''))
+
+class Flight(object): 
+   def __init__(self): 
+      self.done = threading.Event()
+      self.result = None
+      self.error = None
+
+flights = {} # key -> Flight
+flightlock = threading.Lock()
+coalesced = 0 # Requests that joined one already running
+
+def coalesce(key, func, *args): 
+   """coalesce(object, callable, ...) -> object
+   Calls func(*args), unless a call with the same key is already running, in 
+   which case it waits for that to finish instead. Either way, it returns the 
+   result, or raises the exception.
+   """
+   global coalesced
+   with flightlock: 
+      flight = flights.get(key)
+      leader = flight is None
+      if leader: 
+         flight = flights[key] = Flight()
+      else: coalesced += 1
+
+   if leader: 
+      try: flight.result = func(*args)
+      except: flight.error = sys.exc_info()
+      finally: 
+         with flightlock: 
+            del flights[key]
+         flight.done.set()
+   else: flight.done.wait()
+
+   if flight.error is not None: 
+      raise flight.error[0], flight.error[1], flight.error[2]
+   return flight.result
+
+def get(uri, ttl=None): 
+   """get(str, [number]) -> str
+   Fetches the URI and returns the body. Responses are cached as the server 
+   allows; ttl says how many seconds to treat one as fresh instead, and a ttl 
+   of 0 always fetches it afresh.
+   """
    if not uri.startswith('http'): 
       return
-   u = urllib.urlopen(uri)
-   bytes = u.read()
-   u.close()
+   # Any identical requests already on their way get the same answer
+   if options['cache'] and ttl != 0: 
+      return coalesce(('GET', normalize(uri)), cache.fetch, uri, ttl)
+   return coalesce(('GET', normalize(uri), 0), fetch, uri)
+
+def fetch(uri): 
+   with request(uri) as u: 
+      bytes = u.read()
    return bytes
 
+fetchers = WorkerPool(threads=options['fetchers'], queue=256, overflow='inline')
+
+def submit(uri, ttl=None): 
+   """submit(str, [number]) -> tools.Future
+   Starts get(uri, ttl) in the background. The Future's result() is the body.
+   """
+   host = urlparse.urlsplit(uri).hostname
+   return fetchers.future(host, get, uri, ttl)
+
+def fetch_many(uris, ttl=None): 
+   """fetch_many([str], [number]) -> [str]
+   Gets all the URIs at once (as many at a time as there are fetchers, and 
+   as fast as each host's delay allows), and returns the bodies in order.
+   """
+   futures = [submit(uri, ttl) for uri in uris]
+   return [future.result() for future in futures]
+
+def stats(): 
+   """stats() -> dict
+   Returns the cache figures and how many fetches were coalesced, for the 
+   bot's performance report.
+   """
+   return {'cache': cache.stats(), 'coalesced': coalesced}
+
 def head(uri): 
    if not uri.startswith('http'): 
       return
-   u = urllib.urlopen(uri)
-   info = u.info()
-   u.close()
-   return info
+   # Uncompressed, so Content-Length is the real size
+   headers = {'Accept-Encoding': 'identity'}
+   u = request(uri, 'HEAD', headers=headers, follow=False)
+   u.read() # There's no body, but this puts the connection back
+   if u.status in (405, 501): 
+      # Some servers won't do HEAD
+      u = request(uri, headers=headers, follow=False)
+      u.close()
+   if u.status != 200: 
+      return [u.headers, u.status]
+   return u.headers
 
 def post(uri, query): 
    if not uri.startswith('http'): 
       return
    data = urllib.urlencode(query)
-   u = urllib.urlopen(uri, data)
-   bytes = u.read()
-   u.close()
+   headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+   with request(uri, 'POST', data, headers) as u: 
+      bytes = u.read()
    return bytes
 
 r_entity = re.compile(r'&([^;\s]+);')